@@ -0,0 +1,267 @@
+import argparse
+import time
+
+import copy
+from functools import partial
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import models_vit
+from spike_quan_layer import LLLinear, Attention_no_softmax, MyQuan, QuanLinear, QuanConv2d, IFNeuron, ORIIFNeuron
+from spike_quan_wrapper import myquan_replace, calibrate_quantizers, SNNWrapper
+from int_engine import convert_to_int_engine
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SNN kernel benchmark', add_help=False)
+    parser.add_argument('--bench', default='spike_accumulate', type=str,
+                        help='benchmark to run ["spike_accumulate", "attention", "sparse_weight", "int_engine", "quantized_weight", "multistep"]')
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--tokens', default=197, type=int,
+                        help='tokens per sample (197 for ViT-*/16 at 224x224)')
+    parser.add_argument('--in_features', default=384, type=int)
+    parser.add_argument('--out_features', default=1536, type=int)
+    parser.add_argument('--rates', default=[0.01, 0.02, 0.05, 0.1, 0.15, 0.2], type=float, nargs='+',
+                        help='firing rates (fraction of non-zero inputs) to measure')
+    parser.add_argument('--threshold', default=0.05, type=float,
+                        help='spike amplitude theta of the ternary inputs')
+    parser.add_argument('--prune_ratios', default=[0.5, 0.7, 0.9, 0.95, 0.98], type=float, nargs='+',
+                        help='fractions of the weights pruned (by magnitude) in the sparse_weight benchmark')
+    parser.add_argument('--num_tokens', default=[197, 401, 785, 1569, 3136], type=int, nargs='+',
+                        help='sequence lengths N of the attention benchmark')
+    parser.add_argument('--embed_dim', default=384, type=int)
+    parser.add_argument('--num_heads', default=6, type=int)
+    parser.add_argument('--attention_chunk', default=256, type=int,
+                        help='query rows per block of the chunked attention')
+    parser.add_argument('--depth', default=12, type=int,
+                        help='ViT blocks of the int_engine benchmark')
+    parser.add_argument('--img_size', default=224, type=int)
+    parser.add_argument('--level', default=16, type=int,
+                        help='activation quantization levels of the QANN')
+    parser.add_argument('--weight_quantization_bit', default=8, type=int,
+                        help='weight bits of the QANN (32: float weights, int8 per channel in the engine)')
+    parser.add_argument('--calib_batches', default=4, type=int)
+    parser.add_argument('--time_step', default=128, type=int,
+                        help='SNN timesteps of the quantized_weight check')
+    parser.add_argument('--neuron_steps', default=[4, 16, 64], type=int, nargs='+',
+                        help='timesteps T per call of the multistep benchmark')
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument('--threads', default=0, type=int,
+                        help='torch CPU threads (0: keep the default)')
+    return parser
+
+
+def measure(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def ternary_spikes(shape, rate, threshold):
+    # {-theta, 0, +theta} with a fraction `rate` of non-zero entries, half of them negative
+    fire = torch.rand(shape) < rate
+    sign = torch.where(torch.rand(shape) < 0.5, -1.0, 1.0)
+    return fire * sign * threshold
+
+
+def quantized_linear(args, in_features, out_features):
+    # a frozen (eval-cached) QuanLinear with --weight_quantization_bit bit weights, nn.Linear for 32
+    linear = nn.Linear(in_features, out_features)
+    if args.weight_quantization_bit >= 32:
+        return linear
+    linear = QuanLinear(linear, quan_w_fn=MyQuan(level=2 ** args.weight_quantization_bit, sym=True)).eval()
+    linear.quan_w_fn.s.data = linear.weight.abs().max() / 2 ** (args.weight_quantization_bit - 1)
+    return linear.freeze()
+
+
+@torch.no_grad()
+def bench_spike_accumulate(args):
+    layer = LLLinear(quantized_linear(args, args.in_features, args.out_features), neuron_type='ST-BIF', level=16)
+    layer.realize_time = 0
+    bias = layer.linear.bias
+    print("LLLinear {}->{} ({}-bit weights) on {}x{} tokens, {} threads".format(
+        args.in_features, args.out_features, args.weight_quantization_bit, args.batch_size, args.tokens, torch.get_num_threads()))
+    print("{:>6} {:>12} {:>12} {:>8} {:>10}".format("rate", "dense(ms)", "accum(ms)", "speedup", "max_err"))
+    for rate in args.rates:
+        x = ternary_spikes((args.batch_size, args.tokens, args.in_features), rate, args.threshold)
+        # dense reference of the ST-BIF path: (x W^T + b) - b, W quantized by the wrapped layer
+        dense = layer.linear(x) - bias
+        accum = layer.spike_accumulate_linear(x)
+        dense_time = measure(lambda: layer.linear(x) - bias, args.repeats)
+        accum_time = measure(lambda: layer.spike_accumulate_linear(x), args.repeats)
+        print("{:>6.2f} {:>12.3f} {:>12.3f} {:>8.2f} {:>10.2e}".format(
+            rate, dense_time * 1e3, accum_time * 1e3, dense_time / accum_time, (dense - accum).abs().max().item()))
+
+
+@torch.no_grad()
+def bench_attention(args):
+    # softmax-free attention: quadratic relu(QK^T)/N V vs row-chunked vs Q(K^T V)/N, all exact; the
+    # linear path needs non-negative q and k, given here by non-negative inputs and q/k projections
+    attn = Attention_no_softmax(args.embed_dim, num_heads=args.num_heads, qkv_bias=True).eval()
+    attn.qkv.weight[:2 * args.embed_dim].abs_()
+    attn.qkv.bias[:2 * args.embed_dim].abs_()
+    print("Attention_no_softmax dim {} heads {} batch {}, {} threads".format(
+        args.embed_dim, args.num_heads, args.batch_size, torch.get_num_threads()))
+    print("{:>6} {:>10} {:>12} {:>12} {:>12} {:>10} {:>10}".format(
+        "N", "map(MB)", "dense(ms)", "chunked(ms)", "linear(ms)", "chunk_err", "lin_err"))
+    for N in args.num_tokens:
+        x = torch.rand(args.batch_size, N, args.embed_dim)
+        times, outputs = [], []
+        for chunk, linear in ((0, False), (args.attention_chunk, False), (0, True)):
+            attn.attention_chunk, attn.linear_attention = chunk, linear
+            outputs.append(attn(x))
+            times.append(measure(lambda: attn(x), args.repeats))
+        map_mb = args.batch_size * args.num_heads * N * N * 4 / 2 ** 20
+        print("{:>6} {:>10.1f} {:>12.3f} {:>12.3f} {:>12.3f} {:>10.2e} {:>10.2e}".format(
+            N, map_mb, times[0] * 1e3, times[1] * 1e3, times[2] * 1e3,
+            (outputs[1] - outputs[0]).abs().max().item(), (outputs[2] - outputs[0]).abs().max().item()))
+
+
+@torch.no_grad()
+def bench_sparse_weight(args):
+    # pruned LLLinear (like fc2 after unstruct_prune): dense GEMM vs CSR weight, on spike inputs of the first rate
+    layer = LLLinear(quantized_linear(args, args.out_features, args.in_features), neuron_type='ST-BIF', level=16)
+    layer.realize_time = 0
+    weight = layer.linear.weight
+    dense_weight = weight.clone()
+    rate = args.rates[0]
+    x = ternary_spikes((args.batch_size, args.tokens, args.out_features), rate, args.threshold)
+    print("LLLinear {}->{} ({}-bit weights) on {}x{} tokens, rate {:.2f}, {} threads".format(
+        args.out_features, args.in_features, args.weight_quantization_bit, args.batch_size, args.tokens, rate,
+        torch.get_num_threads()))
+    print("{:>6} {:>12} {:>12} {:>8} {:>10}".format("pruned", "dense(ms)", "csr(ms)", "speedup", "max_err"))
+    for ratio in args.prune_ratios:
+        threshold = dense_weight.abs().flatten().kthvalue(max(int(ratio * weight.numel()), 1)).values
+        # pruning in place: the quantized weight and its CSR copy follow through weight_key()
+        weight.copy_(dense_weight * (dense_weight.abs() > threshold))
+        dense = F.linear(x, layer.effective_weight())
+        sparse = layer.sparse_weight_linear(x)
+        dense_time = measure(lambda: F.linear(x, layer.effective_weight()), args.repeats)
+        sparse_time = measure(lambda: layer.sparse_weight_linear(x), args.repeats)
+        print("{:>6.2f} {:>12.3f} {:>12.3f} {:>8.2f} {:>10.2e}".format(
+            ratio, dense_time * 1e3, sparse_time * 1e3, dense_time / sparse_time, (dense - sparse).abs().max().item()))
+
+
+@torch.no_grad()
+def bench_int_engine(args):
+    # fake-quant QANN vs the integer engine, on a random ViT calibrated (percentile) on random images
+    model = models_vit.VisionTransformer(img_size=args.img_size, patch_size=16, embed_dim=args.embed_dim, depth=args.depth,
+                                         num_heads=args.num_heads, mlp_ratio=4, qkv_bias=True, global_pool=False,
+                                         act_layer=nn.ReLU, norm_layer=partial(nn.LayerNorm, eps=1e-6))
+    myquan_replace(model, args.level, args.weight_quantization_bit)
+    images = [(torch.randn(args.batch_size, 3, args.img_size, args.img_size), None) for _ in range(args.calib_batches + 1)]
+    calibrate_quantizers(model, images[:-1], 'cpu', num_batches=args.calib_batches, method="percentile")
+    model.eval()
+    int_model = convert_to_int_engine(copy.deepcopy(model))
+    x = images[-1][0]
+    reference, output = model(x), int_model(x)
+    fake_time = measure(lambda: model(x), args.repeats)
+    int_time = measure(lambda: int_model(x), args.repeats)
+    print("ViT dim {} depth {} heads {}, level {}, weight bits {}, batch {}, {} threads".format(
+        args.embed_dim, args.depth, args.num_heads, args.level, args.weight_quantization_bit, args.batch_size, torch.get_num_threads()))
+    print("logits max_err {:.2e} (max |logit| {:.2e}), top-1 agreement {:.4f}".format(
+        (output - reference).abs().max().item(), reference.abs().max().item(),
+        (output.argmax(-1) == reference.argmax(-1)).float().mean().item()))
+    print("{:>12} {:>12} {:>8}".format("fake(img/s)", "int(img/s)", "speedup"))
+    print("{:>12.2f} {:>12.2f} {:>8.2f}".format(args.batch_size / fake_time, args.batch_size / int_time, fake_time / int_time))
+
+
+@torch.no_grad()
+def bench_quantized_weight(args):
+    # correctness check for weights quantized to --weight_quantization_bit bits: every LLLinear path on
+    # ternary spikes against the original per-step formula (x W_q^T + b) - b (+ b/steps in the
+    # realizing step), then the SNN of a small ViT against the same SNN on pre-quantized weights
+    linear = QuanLinear(nn.Linear(args.in_features, args.out_features),
+                        quan_w_fn=MyQuan(level=2 ** args.weight_quantization_bit, sym=True)).eval()
+    linear.quan_w_fn.s.data = linear.weight.abs().max() / 2 ** (args.weight_quantization_bit - 1)
+    steps = 8
+    x_seq = [ternary_spikes((args.batch_size, args.tokens, args.in_features), args.rates[0], args.threshold) for _ in range(steps)]
+    reference = [linear(x) - linear.bias + (linear.bias if t == 0 else 0) for t, x in enumerate(x_seq)]
+    print("LLLinear {}->{} around a {}-bit QuanLinear, {} steps at rate {:.2f}".format(
+        args.in_features, args.out_features, args.weight_quantization_bit, steps, args.rates[0]))
+    print("{:>18} {:>10} {:>10}".format("path", "max_err", "identical"))
+    for path in ("dense", "row_sparse", "spike_accumulate", "sparse_weight"):
+        layer = LLLinear(linear, neuron_type='ST-BIF', level=args.level)
+        layer.row_sparse, layer.row_sparse_threshold = path == "row_sparse", 1.0
+        layer.spike_accumulate = path == "spike_accumulate"
+        layer.sparse_weight, layer.sparse_weight_faster = path == "sparse_weight", True
+        outputs = [layer(x) for x in x_seq]
+        print("{:>18} {:>10.2e} {:>10}".format(path, max((o - r).abs().max().item() for o, r in zip(outputs, reference)),
+                                              str(all(torch.equal(o, r) for o, r in zip(outputs, reference)))))
+
+    # the same SNN once with the weights quantized by its layers, once with them stored pre-quantized
+    model = models_vit.VisionTransformer(img_size=32, patch_size=16, embed_dim=48, depth=2, num_heads=3, mlp_ratio=2,
+                                         qkv_bias=True, num_classes=10, global_pool=False,
+                                         act_layer=nn.ReLU, norm_layer=partial(nn.LayerNorm, eps=1e-6))
+    myquan_replace(model, args.level, args.weight_quantization_bit)
+    images = [(torch.randn(args.batch_size, 3, 32, 32), None) for _ in range(args.calib_batches + 1)]
+    calibrate_quantizers(model, images[:-1], 'cpu', num_batches=args.calib_batches, method="percentile")
+    model.eval()
+    prequantized = copy.deepcopy(model)
+    for module in prequantized.modules():
+        if isinstance(module, (QuanLinear, QuanConv2d)):
+            # quantizing k*s again gives k*s, so only a path that skips the quantization differs
+            module.weight.data = module.quantized_weight()
+    x = images[-1][0]
+    print("{:>18} {:>10} {:>10}".format("SNN mode", "max_err", "identical"))
+    for mode, kwargs in (("dense", {}), ("row_sparse", {"row_sparse": True, "row_sparse_threshold": 1.0}),
+                         ("spike_accumulate", {"spike_accumulate": []}), ("sparse_weight", {"sparse_weight": []})):
+        outputs = []
+        for ann in (model, prequantized):
+            snn = SNNWrapper(ann_model=copy.deepcopy(ann), cfg=None, time_step=args.time_step, Encoding_type="analog",
+                             level=args.level, neuron_type="ST-BIF", model_name="vit_small", is_softmax=True, **kwargs).eval()
+            outputs.append(snn(x)[0])
+        print("{:>18} {:>10.2e} {:>10}".format(mode, (outputs[0] - outputs[1]).abs().max().item(),
+                                              str(torch.equal(outputs[0], outputs[1]))))
+
+
+@torch.no_grad()
+def bench_multistep(args):
+    # IFNeuron/ORIIFNeuron: T single-step calls vs one multi-step call on the [T, B, N, C] input
+    shape = (args.batch_size, args.tokens, args.in_features)
+    print("neurons on {}x{}x{}, {} threads".format(*shape, torch.get_num_threads()))
+    print("{:>12} {:>4} {:>12} {:>12} {:>8} {:>10}".format("neuron", "T", "single(ms)", "multi(ms)", "speedup", "identical"))
+    for neuron_class in (IFNeuron, ORIIFNeuron):
+        for steps in args.neuron_steps:
+            # integer multiples of theta/4: fractional membrane input with exact float sums
+            x_seq = torch.round(torch.randn((steps,) + shape) * 2) * (args.threshold / 4)
+
+            def run(step_mode):
+                neuron = neuron_class(torch.tensor(args.threshold), args.level, sym=neuron_class is IFNeuron)
+                neuron.step_mode = step_mode
+                if step_mode == 'm':
+                    return neuron(x_seq)
+                return [neuron(x) for x in x_seq]
+
+            identical = torch.equal(torch.stack(run('s')), run('m'))
+            single_time = measure(lambda: run('s'), args.repeats)
+            multi_time = measure(lambda: run('m'), args.repeats)
+            print("{:>12} {:>4} {:>12.3f} {:>12.3f} {:>8.2f} {:>10}".format(
+                neuron_class.__name__, steps, single_time * 1e3, multi_time * 1e3, single_time / multi_time, str(identical)))
+
+
+BENCHMARKS = {
+    "spike_accumulate": bench_spike_accumulate,
+    "attention": bench_attention,
+    "sparse_weight": bench_sparse_weight,
+    "int_engine": bench_int_engine,
+    "quantized_weight": bench_quantized_weight,
+    "multistep": bench_multistep,
+}
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    BENCHMARKS[args.bench](args)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -417,6 +417,9 @@ def evaluate(data_loader, model, device, args):
     
     max_T = 0
     # count1 = 0
+    stopping_policy = model.module.stopping_policy if args.mode == "SNN" else None
+    if stopping_policy is not None:
+        stopping_policy.clear_stats()
 
     for batch in metric_logger.log_every(data_loader, 1, header):
         images = batch[0]
@@ -429,23 +432,23 @@ def evaluate(data_loader, model, device, args):
             if args.mode != "SNN":
                 output = model(images)
             else:
-                # accu_per_timestep: cur_T * B * n_classes
-                output, count, accu_per_timestep = model.module(images, verbose=True)
-                # print(accu_per_timestep.shape, count)
+                # count the correct predictions online: one scalar per timestep instead of cur_T * B * n_classes logits
+                correct_online = []
+                handle = model.module.register_step_hook(
+                    lambda t, accu_t: correct_online.append((accu_t.argmax(-1) == target).sum()))
+                output, count = model.module(images)
+                handle.remove()
+                # print(count)
                 max_T = max(max_T, count)
                 # print(max_T)
-                if accu_per_timestep.shape[0] < max_T:
-                    padding_per_timestep = accu_per_timestep[-1].unsqueeze(0)
-                    padding_length = max_T - accu_per_timestep.shape[0]
-                    accu_per_timestep = torch.cat(
-                        [accu_per_timestep, padding_per_timestep.repeat(padding_length, 1, 1)], dim=0)
-
                 if correct_per_timestep is not None and correct_per_timestep.shape[0] < max_T:
                     for t in range(correct_per_timestep.shape[0], max_T):
                         metric_logger.meters['acc@{}'.format(t + 1)] = deepcopy(metric_logger.meters['acc@{}'.format(correct_per_timestep.shape[0])])
 
-                _, predicted_per_time_step = torch.max(accu_per_timestep.data, 2)
-                correct_per_timestep = torch.sum((predicted_per_time_step == target.unsqueeze(0)), dim=1)
+                correct_per_timestep = torch.stack(correct_online[:count])
+                if correct_per_timestep.shape[0] < max_T:
+                    correct_per_timestep = torch.cat(
+                        [correct_per_timestep, correct_per_timestep[-1:].repeat(max_T - correct_per_timestep.shape[0])])
 
                 # if correct_per_timestep is None:
                 #     _, predicted_per_time_step = torch.max(accu_per_timestep.data, 2)
@@ -469,9 +472,12 @@ def evaluate(data_loader, model, device, args):
         metric_logger.meters['acc1'].update(acc1.item(), n=batch_size)
         metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
         if args.mode == "SNN":
-            for t in range(max_T):
+            for t, correct in enumerate(correct_per_timestep.tolist()):
                 metric_logger.meters['acc@{}'.format(t + 1)].update(
-                    correct_per_timestep[t].cpu().item() * 100. / batch_size, n=batch_size)
+                    correct * 100. / batch_size, n=batch_size)
+            if model.module.sample_T is not None:
+                # timesteps each sample actually needed (early exit / stopping policy)
+                metric_logger.meters['mean_T'].update(model.module.sample_T.float().mean().item(), n=batch_size)
             model.module.reset()
 
         # count1 += 1
@@ -483,5 +489,11 @@ def evaluate(data_loader, model, device, args):
     metric_logger.synchronize_between_processes()
     print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
           .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
+    if args.mode == "SNN" and getattr(args, "head_skip", False):
+        print('* Attention heads {}'.format(model.module.head_activity_stats()))
+    if stopping_policy is not None:
+        mean_T = metric_logger.meters['mean_T'].global_avg if 'mean_T' in metric_logger.meters else max_T
+        print('* Stopping policy {} mean_T {:.2f} {}'.format(type(stopping_policy).__name__,
+              mean_T, stopping_policy.summary()))
 
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
\ No newline at end of file
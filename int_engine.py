@@ -0,0 +1,178 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timm.models.vision_transformer import Block
+from spike_quan_layer import MyQuan, QAttention, QuanLinear
+
+'''
+Integer-arithmetic CPU inference of a QANN (a ViT after myquan_replace). The activations between a
+MyQuan and the next linear layer are kept as the integer levels of the quantizer (int8), the
+linear layers run as int8 x int8 -> int32 GEMMs (torch._int_mm) and the requantization to the
+next quantizer is folded into one multiplier per output channel. q @ k^T and attn @ v multiply
+the integer levels exactly on a float carrier (the products stay far below 2^24). LayerNorm,
+softmax and the residual stream stay in float: the residual sums outputs of different scales.
+'''
+
+def quantizer_bounds(quantizer):
+    return int(float(quantizer.neg_min)), int(float(quantizer.pos_max))
+
+def quantizer_step(quantizer):
+    return float(quantizer.s.detach())
+
+def int_quantize(x,s,neg_min,pos_max):
+    # the levels of MyQuan: clamp(floor(x/s + 0.5), neg_min, pos_max)
+    return torch.clamp(torch.floor(x/s + 0.5), min=neg_min, max=pos_max).to(torch.int8)
+
+def check_int8(quantizer):
+    neg_min, pos_max = quantizer_bounds(quantizer)
+    if neg_min < -128 or pos_max > 127:
+        raise ValueError(f"quantizer levels [{neg_min}, {pos_max}] do not fit int8")
+    return neg_min, pos_max
+
+class IntQuantizer(nn.Module):
+    '''
+    Replaces a MyQuan whose output feeds integer layers: returns its int8 levels instead of levels*s.
+    '''
+    def __init__(self,quantizer):
+        super(IntQuantizer,self).__init__()
+        self.s = quantizer_step(quantizer)
+        self.neg_min, self.pos_max = check_int8(quantizer)
+
+    def forward(self,x):
+        return int_quantize(x,self.s,self.neg_min,self.pos_max)
+
+class IntLinear(nn.Module):
+    '''
+    int8 linear layer with the input scale input_s (None: float input, run as a float GEMM on the
+    dequantized weight). The weight levels come from the MyQuan of a QuanLinear with at most 8 bits,
+    otherwise from a symmetric per-output-channel int8 quantization. With output quantizers
+    (one per output channel group, in order) the output are their int8 levels, folded as
+        floor(acc*(input_s*weight_s/out_s) + bias/out_s + 0.5)
+    else the float output acc*input_s*weight_s + bias.
+    '''
+    def __init__(self,linear,input_s=None,output_quantizers=None):
+        super(IntLinear,self).__init__()
+        # a QuanLinear's quantized weight: also there after freeze(drop_weight=True)
+        weight = (linear.quantized_weight() if isinstance(linear, QuanLinear) else linear.weight).detach().float()
+        out_features = weight.shape[0]
+        if isinstance(linear, QuanLinear) and linear.quan_w_fn.pos_max != 'full' and linear.quan_w_fn.level <= 256:
+            weight_s = torch.full((out_features,),quantizer_step(linear.quan_w_fn))
+            weight_int = int_quantize(weight,weight_s[:,None],*quantizer_bounds(linear.quan_w_fn))
+        else:
+            weight_s = weight.abs().amax(dim=1).clamp(min=1e-12)/127
+            weight_int = int_quantize(weight,weight_s[:,None],-127,127)
+        self.register_buffer("weight_t",weight_int.t().contiguous())
+        self.register_buffer("weight_s",weight_s)
+        bias = linear.bias.detach().float() if linear.bias is not None else torch.zeros(out_features)
+        self.register_buffer("bias",bias)
+        self.input_s = input_s
+        self.out_features = out_features
+
+        self.output_bounds = None
+        if output_quantizers is not None:
+            out_s = torch.cat([torch.full((out_features//len(output_quantizers),),quantizer_step(q)) for q in output_quantizers])
+            bounds = [check_int8(q) for q in output_quantizers]
+            assert all(b == bounds[0] for b in bounds), "output quantizers with different levels"
+            self.output_bounds = bounds[0]
+            # requantization folded into one multiplier and offset per output channel
+            scale = (input_s if input_s is not None else 1.0)*weight_s
+            self.register_buffer("requant_scale",scale/out_s)
+            self.register_buffer("requant_bias",bias/out_s + 0.5)
+            self.register_buffer("requant_float_scale",1.0/out_s)
+
+    def forward(self,x):
+        shape = x.shape[:-1]
+        x = x.reshape(-1,x.shape[-1])
+        if self.input_s is None:
+            acc = F.linear(x,(self.weight_t.t().float()*self.weight_s[:,None]))
+            if self.output_bounds is None:
+                return (acc + self.bias).reshape(shape+(self.out_features,))
+            output = torch.floor(acc*self.requant_float_scale + self.requant_bias)
+        else:
+            acc = torch._int_mm(x,self.weight_t).float()
+            if self.output_bounds is None:
+                return (acc*(self.input_s*self.weight_s) + self.bias).reshape(shape+(self.out_features,))
+            output = torch.floor(acc*self.requant_scale + self.requant_bias)
+        output = torch.clamp(output,min=self.output_bounds[0],max=self.output_bounds[1]).to(torch.int8)
+        return output.reshape(shape+(self.out_features,))
+
+class IntQAttention(nn.Module):
+    '''
+    QAttention on the int8 levels of its input quantizer; returns the float output of quan_proj.
+    '''
+    def __init__(self,attn,input_quantizer):
+        super(IntQAttention,self).__init__()
+        self.num_heads = attn.num_heads
+        self.head_dim = attn.head_dim
+        self.is_softmax = attn.is_softmax
+        self.qkv = IntLinear(attn.qkv,quantizer_step(input_quantizer),[attn.quan_q,attn.quan_k,attn.quan_v])
+        s_q, s_k, s_v = quantizer_step(attn.quan_q), quantizer_step(attn.quan_k), quantizer_step(attn.quan_v)
+        self.attn_s = quantizer_step(attn.attn_quan)
+        self.attn_bounds = check_int8(attn.attn_quan)
+        self.after_attn_s = quantizer_step(attn.after_attn_quan)
+        self.after_attn_bounds = check_int8(attn.after_attn_quan)
+        self.score_scale = s_q*attn.scale*s_k
+        self.v_s = s_v
+        self.proj = IntLinear(attn.proj,self.after_attn_s,[attn.quan_proj])
+        self.proj_s = quantizer_step(attn.quan_proj)
+
+    def forward(self,x):
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.float().unbind(0)
+        # integer levels on a float carrier: exact products
+        attn = (q @ k.transpose(-2, -1))*self.score_scale
+        if self.is_softmax:
+            attn = int_quantize(attn.softmax(dim=-1),self.attn_s,*self.attn_bounds)
+            scale = self.attn_s*self.v_s/self.after_attn_s
+        else:
+            attn = int_quantize(attn,self.attn_s,*self.attn_bounds)
+            scale = self.attn_s*self.v_s/N/self.after_attn_s
+        x = attn.float() @ v
+        x = torch.clamp(torch.floor(x*scale + 0.5),min=self.after_attn_bounds[0],max=self.after_attn_bounds[1]).to(torch.int8)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        return self.proj(x).float()*self.proj_s
+
+class IntMlp(nn.Module):
+    '''
+    Mlp of myquan_replace (fc1, act = (MyQuan, act), fc2 = (fc2, MyQuan)) on the int8 levels of its
+    input quantizer; returns the float output of the fc2 quantizer. A ReLU after the unsigned act
+    quantizer leaves its levels unchanged, so fc2 stays integer; any other activation makes fc2
+    a float GEMM on the activated values.
+    '''
+    def __init__(self,mlp,input_quantizer):
+        super(IntMlp,self).__init__()
+        act_quan, self.act = mlp.act[0], mlp.act[1]
+        self.act_s = quantizer_step(act_quan)
+        self.fc1 = IntLinear(mlp.fc1,quantizer_step(input_quantizer),[act_quan])
+        self.integer_act = isinstance(self.act, nn.ReLU)
+        self.fc2 = IntLinear(mlp.fc2[0],self.act_s if self.integer_act else None,[mlp.fc2[1]])
+        self.fc2_s = quantizer_step(mlp.fc2[1])
+
+    def forward(self,x):
+        x = self.fc1(x)
+        if not self.integer_act:
+            x = self.act(x.float()*self.act_s)
+        return self.fc2(x).float()*self.fc2_s
+
+def convert_to_int_engine(model):
+    '''
+    Turn a QANN ViT (after myquan_replace, eval mode) into the integer engine in place: every Block's
+    norm quantizers return int8 levels, its attention and Mlp run on them, and the head runs as an
+    int8 GEMM on the levels of the final norm quantizer. Patch embedding, LayerNorm and the residual
+    stream stay float.
+    '''
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, Block) and isinstance(module.attn, QAttention):
+            norm1_quan, norm2_quan = module.norm1[1], module.norm2[1]
+            module.attn = IntQAttention(module.attn,norm1_quan)
+            module.mlp = IntMlp(module.mlp,norm2_quan)
+            module.norm1[1] = IntQuantizer(norm1_quan)
+            module.norm2[1] = IntQuantizer(norm2_quan)
+    norm = model.fc_norm if getattr(model, "global_pool", False) else model.norm
+    if isinstance(norm, nn.Sequential) and isinstance(norm[1], MyQuan) and isinstance(model.head, nn.Linear):
+        head_quan = norm[1]
+        norm[1] = IntQuantizer(head_quan)
+        model.head = IntLinear(model.head,quantizer_step(head_quan))
+    return model
@@ -31,10 +31,11 @@ from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 
 import util.lr_decay as lrd
 import util.misc as misc
-from util.datasets import build_dataset
+from util.datasets import build_dataset, build_transform
 from util.pos_embed import interpolate_pos_embed
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
-from spike_quan_wrapper import myquan_replace, SNNWrapper
+from spike_quan_wrapper import myquan_replace, SNNWrapper, build_stopping_policy, calibrate_quantizers, set_frozen_weights, set_attention_chunk
+from int_engine import convert_to_int_engine
 
 import models_vit
 import wandb
@@ -183,8 +184,22 @@ def get_args_parser():
     
     # training mode
     parser.add_argument('--mode', default="ANN", type=str,
-                        help='the running mode of the script["ANN", "QANN_PTQ", "QANN_QAT", "SNN"]')
+                        help='the running mode of the script["ANN", "QANN-PTQ", "QANN-QAT", "SNN"]')
     # prune
+    parser.add_argument('--calibrate', action='store_true',
+                        help='QANN: initialize the quantizer steps from calibrated clipping thresholds (always on in QANN-PTQ mode)')
+    parser.add_argument('--calib_method', default="kl", type=str,
+                        help='threshold calibration criterion ["kl", "percentile", "mse"]')
+    parser.add_argument('--calib_batches', default=32, type=int,
+                        help='training batches swept by the calibration')
+    parser.add_argument('--calib_percentile', default=99.99, type=float,
+                        help='percentile of |x| clipped at by the percentile calibration')
+    parser.add_argument('--int_engine', action='store_true',
+                        help='QANN evaluation (--eval or QANN-PTQ) with int8 GEMMs on the CPU instead of fake quantization')
+    parser.add_argument('--freeze_weights', action='store_true',
+                        help='evaluation: quantize the QuanLinear/QuanConv2d weights once and reuse them instead of every forward')
+    parser.add_argument('--drop_float_weights', action='store_true',
+                        help='with --freeze_weights and --eval (or QANN-PTQ): free the float weights, keeping only the quantized ones')
     parser.add_argument('--ratio', default=0.0, type=float,
                         help='the ratio of unstructure prune')
     # LSQ quantization
@@ -195,6 +210,42 @@ def get_args_parser():
                         help='neuron type["ST-BIF", "IF"]')
     parser.add_argument('--remove_softmax', action='store_true',
                         help='need softmax or not')
+    # --linear_attention (main_finetune_distill.py) only acts on the Attention_no_softmax of remove_softmax(),
+    # which this script never builds; --remove_softmax here makes the QAttention/SAttention softmax-free
+    parser.add_argument('--attention_chunk', default=0, type=int,
+                        help='evaluate the QANN attention over blocks of this many query rows (0: whole N x N map)')
+    parser.add_argument('--compact_state', action='store_true',
+                        help='store the SNN neuron spike counts and outputs in integer tensors (exact)')
+    parser.add_argument('--persistent_state', action='store_true',
+                        help='allocate the SNN state buffers once and reuse them across evaluation batches')
+    parser.add_argument('--finish_check_interval', default=0, type=int,
+                        help='read the SNN finish flag from the device every k timesteps (0: check every module every timestep)')
+    parser.add_argument('--early_exit', action='store_true',
+                        help='freeze the logits of quiescent samples and drop them from the SNN batch')
+    parser.add_argument('--row_sparse', action='store_true',
+                        help='run the SNN linear layers only on the tokens that carry spikes')
+    parser.add_argument('--row_sparse_threshold', default=None, type=float,
+                        help='token density up to which the sparse path is used (default: calibrated per layer)')
+    parser.add_argument('--spike_accumulate', default=None, type=str, nargs='*',
+                        help='on CPU, accumulate weight columns instead of a GEMM for ternary spike inputs in the SNN linear layers '
+                             'whose name contains one of the given strings (no string: all linear layers)')
+    parser.add_argument('--sparse_weight', default=None, type=str, nargs='*',
+                        help='store the weights of the SNN linear layers whose name contains one of the given strings as CSR '
+                             '(no string: the layers pruned by --ratio, proj and fc2), used where faster than the dense GEMM')
+    parser.add_argument('--head_skip', action='store_true',
+                        help='only update the SNN attention heads that receive spikes or still fire')
+    parser.add_argument('--row_skip_softmax', action='store_true',
+                        help='only recompute the spiking softmax rows whose input changed in the current step')
+    parser.add_argument('--row_skip_layernorm', action='store_true',
+                        help='only renormalize the spiking LayerNorm tokens whose input changed in the current step')
+    parser.add_argument('--stopping_policy', default="none", type=str,
+                        help='anytime stopping policy of the SNN ["none", "stable", "margin", "entropy"]')
+    parser.add_argument('--policy_threshold', default=0.5, type=float,
+                        help='softmax margin (margin) or entropy in nats (entropy) at which a sample stops')
+    parser.add_argument('--policy_patience', default=10, type=int,
+                        help='consecutive timesteps the top-1 class must stay unchanged (stable)')
+    parser.add_argument('--policy_min_T', default=1, type=int,
+                        help='timesteps to run before the stopping policy may stop a sample')
     
     return parser
 
@@ -223,6 +274,8 @@ def main(args):
     print("{}".format(args).replace(', ', ',\n'))
 
     device = torch.device(args.device)
+    if args.int_engine and args.distributed:
+        raise ValueError("--int_engine evaluates on the CPU in a single process, run it without distributed mode")
 
     # fix the seed for reproducibility
     seed = args.seed + misc.get_rank()
@@ -327,8 +380,10 @@ def main(args):
         print("Load pre-trained checkpoint from: %s" % args.finetune)
         checkpoint_model = checkpoint['model']
         state_dict = model.state_dict()
+        # QANN-PTQ quantizes a finetuned model as is: its head must load, not be re-initialized
+        ptq = args.mode.count("PTQ") > 0
         for k in ['head.weight', 'head.bias']:
-            if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
+            if not ptq and k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
                 print(f"Removing key {k} from pretrained checkpoint")
                 del checkpoint_model[k]
 
@@ -345,7 +400,8 @@ def main(args):
         #     assert set(msg.missing_keys) == {'head.weight', 'head.bias'}
 
         # manually initialize fc layer
-        trunc_normal_(model.head.weight, std=2e-5)
+        if not ptq:
+            trunc_normal_(model.head.weight, std=2e-5)
 
     if args.rank == 0:
         print("======================== ANN model ========================")
@@ -413,7 +469,15 @@ def main(args):
 
         # manually initialize fc layer
         # trunc_normal_(model.head.weight, std=2e-5)
-        model = SNNWrapper(ann_model=model, cfg=None, time_step=args.time_step, Encoding_type=args.encoding_type, level=args.level, neuron_type=args.neuron_type, model_name=args.model, is_softmax = not args.remove_softmax)
+        model = SNNWrapper(ann_model=model, cfg=None, time_step=args.time_step, Encoding_type=args.encoding_type, level=args.level, neuron_type=args.neuron_type, model_name=args.model, is_softmax = not args.remove_softmax,
+                           compact_state=args.compact_state,
+                           persistent_state=args.persistent_state, finish_check_interval=args.finish_check_interval,
+                           early_exit=args.early_exit, row_sparse=args.row_sparse, row_sparse_threshold=args.row_sparse_threshold,
+                           spike_accumulate=args.spike_accumulate, head_skip=args.head_skip,
+                           sparse_weight=args.sparse_weight,
+                           row_skip_softmax=args.row_skip_softmax, row_skip_layernorm=args.row_skip_layernorm,
+                           stopping_policy=build_stopping_policy(args.stopping_policy, threshold=args.policy_threshold,
+                                                                 patience=args.policy_patience, min_T=args.policy_min_T))
         
         # caculate the sparsity
         if args.ratio > 0.0:
@@ -427,7 +491,36 @@ def main(args):
             f.close()
         
 
+    if args.attention_chunk > 0:
+        set_attention_chunk(model, chunk=args.attention_chunk)
     model.to(device)
+    if args.mode.count("QANN") > 0 and (args.calibrate or args.mode.count("PTQ") > 0):
+        # calibrate on un-augmented training images, the same seeded subset on every rank
+        dataset_calib = build_dataset(is_train=True, args=args)
+        dataset_calib.transform = build_transform(False, args)
+        data_loader_calib = torch.utils.data.DataLoader(
+            dataset_calib, sampler=torch.utils.data.RandomSampler(dataset_calib, generator=torch.Generator().manual_seed(args.seed)),
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_mem,
+            drop_last=False
+        )
+        calibrate_quantizers(model, data_loader_calib, device, num_batches=args.calib_batches,
+                             method=args.calib_method, percentile=args.calib_percentile)
+        if args.mode.count("PTQ") > 0:
+            # post-training quantization: the calibrated QANN checkpoint, loadable by --mode SNN --finetune
+            if args.output_dir:
+                misc.save_on_master({'model': model.state_dict(), 'args': args},
+                                    os.path.join(args.output_dir, "checkpoint-ptq.pth"))
+            if args.freeze_weights:
+                set_frozen_weights(model, drop_weight=args.drop_float_weights)
+            if args.int_engine:
+                # the engine runs its int8 GEMMs on the CPU
+                device = torch.device("cpu")
+                convert_to_int_engine(model.to(device))
+            test_stats = evaluate(data_loader_val, model, device, args)
+            print(f"Accuracy of the calibrated QANN on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
+            exit(0)
 
     model_without_ddp = model if args.mode != "SNN" else model.model
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -471,6 +564,15 @@ def main(args):
     if args.mode != "SNN":
         misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
 
+    if args.freeze_weights:
+        # after every checkpoint load: a dropped float weight can no longer be loaded into or trained
+        set_frozen_weights(model, drop_weight=args.drop_float_weights and args.eval)
+
+    if args.int_engine and args.eval and args.mode.count("QANN") > 0:
+        # after misc.load_model, which loads the checkpoint into the float QuanLinear weights
+        device = torch.device("cpu")
+        convert_to_int_engine(model.to(device))
+
     if args.eval:
         if args.energy_eval:
             from energy_consumption_calculation import get_model_complexity_info
@@ -34,7 +34,7 @@ import util.misc as misc
 from util.datasets import build_dataset
 from util.pos_embed import interpolate_pos_embed
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
-from spike_quan_wrapper import myquan_replace, SNNWrapper, remove_softmax
+from spike_quan_wrapper import myquan_replace, SNNWrapper, remove_softmax, set_attention_chunk
 
 import models_vit
 import wandb
@@ -197,6 +197,10 @@ def get_args_parser():
                         help='neuron type["ST-BIF", "IF"]')
     parser.add_argument('--remove_softmax', action='store_true',
                         help='need softmax or not')
+    parser.add_argument('--attention_chunk', default=0, type=int,
+                        help='evaluate the (Q)ANN attention over blocks of this many query rows (0: whole N x N map)')
+    parser.add_argument('--linear_attention', action='store_true',
+                        help='softmax-free ANN attention as Q(K^T V)/N wherever that is exact (no negative q or k entry)')
     return parser
 
 
@@ -417,6 +421,8 @@ def main(args):
             f.write(str(model))
             f.close()
 
+    if args.attention_chunk > 0 or args.linear_attention:
+        set_attention_chunk(model, chunk=args.attention_chunk, linear_attention=args.linear_attention)
     model.to(device)
     model_teacher.to(device)
 
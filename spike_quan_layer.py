@@ -3,13 +3,154 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.jit import Final
 import math
-from copy import deepcopy
-import numpy as np
-import scipy
+import time
 
 # torch.set_default_dtype(torch.double)
 # torch.set_default_tensor_type(torch.DoubleTensor)
 
+def st_bif_step(x, q, acc_q, cur_output, pos_max=None, neg_min=None, eps=0, masks=None):
+    '''
+    One ST-BIF timestep, updating q, acc_q and cur_output in place.
+    Equivalent (bit for bit) to the masked-scatter formulation:
+        q += x
+        spike     = (q >= 1) & (acc_q < pos_max)
+        neg_spike = (q < -eps) & (acc_q > neg_min)
+        cur_output = spike - neg_spike
+        acc_q += cur_output; q -= cur_output
+    The two masks can never overlap, so q -= cur_output is the same as the
+    two masked updates. pos_max=None drops the upper bound and neg_min=None
+    disables negative spikes (ORIIFNeuron).
+    Args:
+        x(tensor or float): membrane input already divided by the threshold.
+        q, acc_q, cur_output(tensor): neuron state, modified in place.
+        masks(tuple): two bool tensors shaped like q that the comparisons are
+            written into; None takes the shared ones of mask_buffers.
+    '''
+    q.add_(x)
+    if masks is None:
+        masks = mask_buffers(q)
+    spike_position, bound = masks
+    torch.ge(q, 1, out=spike_position)
+    if pos_max is not None:
+        spike_position.logical_and_(torch.lt(acc_q, pos_max, out=bound))
+    cur_output.copy_(spike_position)
+    if neg_min is not None:
+        neg_spike_position = torch.lt(q, -eps, out=spike_position)
+        neg_spike_position.logical_and_(torch.gt(acc_q, neg_min, out=bound))
+        cur_output.masked_fill_(neg_spike_position, -1)
+    acc_q.add_(cur_output)
+    q.sub_(cur_output)
+    return cur_output
+
+step_masks = {}
+
+def mask_buffers(like):
+    '''
+    The two bool scratch tensors of st_bif_step for a state shaped like `like`. They only live
+    within one step, so all neurons of a trailing shape (all dims but the batch) and device share
+    one pair, kept at the largest batch seen; smaller batches get views of its first rows, so
+    compacted and partial batches allocate nothing.
+    '''
+    key = (like.shape[1:], like.device)
+    batch = like.shape[0] if like.dim() > 0 else 1
+    if key not in step_masks or step_masks[key][0].shape[0] < batch:
+        step_masks[key] = tuple(torch.empty((batch,)+like.shape[1:],dtype=torch.bool,device=like.device) for _ in range(2))
+    return tuple(m[:batch].view(like.shape) for m in step_masks[key])
+
+def mark_activity(activity, *tensors):
+    '''
+    Device-side replacement of the per-module `(x == 0).all()` finish check:
+    OR "any element is non-zero" of every tensor into the shared activity flag
+    without synchronizing with the host. A 0-dim flag tracks the whole batch,
+    a [B] flag tracks every sample (dim 0 of the tensors) separately.
+    '''
+    for t in tensors:
+        if activity.dim() == 0:
+            activity.logical_or_(t.any())
+        else:
+            activity.logical_or_(t.any(dim=tuple(range(1,t.dim()))))
+
+def measure_time(fn, device, repeats=10):
+    # wall-clock time of repeats calls of fn after one warm-up call, synchronizing CUDA devices
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start
+
+def has_forward_hooks(module):
+    # hooks (e.g. the op counters of energy_consumption_calculation) that only see calls of module itself
+    return bool(module._forward_hooks or module._forward_pre_hooks)
+
+def compact_batch(state, index):
+    # keep the batch rows (dim 0) listed in index of a state tensor; float placeholders pass through
+    if torch.is_tensor(state):
+        return state.index_select(0, index)
+    return state
+
+def gather_slices(state, index):
+    # slices `index` of a [B, H, ...] tensor viewed as [B*H, ...]
+    return state.reshape((-1,)+state.shape[2:]).index_select(0, index)
+
+def scatter_slices(state, index, slices):
+    # write gather_slices(state, index) back in place; state must be contiguous
+    state.view((-1,)+state.shape[2:]).index_copy_(0, index, slices)
+
+def smallest_int_dtype(low, high):
+    '''Smallest signed integer dtype that can hold every value in [low, high].'''
+    for dtype in (torch.int8, torch.int16, torch.int32):
+        info = torch.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return torch.int64
+
+shared_zero = {}
+
+def shared_zeros(shape, dtype, device):
+    '''
+    All-zero tensor of the given shape for the quiescent steps of LLLinear/LLConv2d: a broadcast
+    view of one cached zero element per dtype and device, so it costs no allocation. It is shared
+    and read-only; in-place writes into it fail.
+    '''
+    key = (dtype, device)
+    if key not in shared_zero:
+        shared_zero[key] = torch.zeros((),dtype=dtype,device=device)
+    return shared_zero[key].expand(shape)
+
+def is_shared_zeros(x):
+    # a view made by shared_zeros: known to be all zero without reading (or syncing on) the data
+    if not torch.is_tensor(x):
+        return False
+    zero = shared_zero.get((x.dtype, x.device))
+    return zero is not None and x.data_ptr() == zero.data_ptr()
+
+def st_bif_multistep(x_seq, q_threshold, q, acc_q, cur_output, pos_max=None, neg_min=None, eps=0):
+    '''
+    Run st_bif_step over the leading time dimension of x_seq ([T, B, ...]) in a
+    single call and return the spikes of every step times q_threshold as a
+    [T, B, ...] tensor, bit-identical to T single-step calls of the neuron.
+    The state tensors are updated in place exactly as T calls of st_bif_step
+    would leave them. Each step is divided by q_threshold into one reused
+    buffer and its spikes are scaled straight into the output, so the call
+    touches every step once while it is in cache.
+    '''
+    if torch.is_tensor(q_threshold):
+        q_threshold = q_threshold.detach()
+    spikes = torch.empty(x_seq.shape,dtype=x_seq.dtype,device=x_seq.device)
+    x = torch.empty(x_seq.shape[1:],dtype=x_seq.dtype,device=x_seq.device)
+    for t in range(x_seq.shape[0]):
+        st_bif_step(torch.div(x_seq[t], q_threshold, out=x), q, acc_q, cur_output, pos_max=pos_max, neg_min=neg_min, eps=eps)
+        torch.mul(cur_output, q_threshold, out=spikes[t])
+    return spikes
+
+def multistep_work(x_seq, spikes):
+    # is_work of a multi-step call: input or spikes at any of its T steps (spikes may be scaled)
+    return bool(x_seq.ne(0).any() or spikes.ne(0).any())
+
 class ORIIFNeuron(nn.Module):
     def __init__(self,q_threshold,level,sym=False):
         super(ORIIFNeuron,self).__init__()
@@ -25,6 +166,8 @@ class ORIIFNeuron(nn.Module):
         self.neg_min = torch.tensor(0)
             
         self.eps = 0
+        # 's': one timestep per call, 'm': input is [T, B, ...] and all T steps run in one call
+        self.step_mode = 's'
 
     # def __repr__(self):
     #         return f"IFNeuron(level={self.level}, sym={self.sym}, pos_max={self.pos_max}, neg_min={self.neg_min}, q_threshold={self.q_threshold})"
@@ -38,32 +181,42 @@ class ORIIFNeuron(nn.Module):
         self.spike_position = None
         # self.neg_spike_position = None
 
+    def compact(self,index):
+        self.q = compact_batch(self.q,index)
+        self.acc_q = compact_batch(self.acc_q,index)
+        self.cur_output = compact_batch(self.cur_output,index)
+
+    def init_state(self,shape,dtype,device):
+        self.cur_output = torch.zeros(shape,dtype=dtype,device=device)
+        self.acc_q = torch.zeros(shape,dtype=torch.float32,device=device)
+        self.q = torch.full(shape,0.5,dtype=torch.float32,device=device)
+
+    def multi_step_forward(self,x_seq):
+        x_seq = x_seq.detach()
+        if not torch.is_tensor(self.cur_output):
+            self.init_state(x_seq.shape[1:],x_seq.dtype,x_seq.device)
+
+        spikes = st_bif_multistep(x_seq, self.q_threshold, self.q, self.acc_q, self.cur_output)
+        self.is_work = multistep_work(x_seq, spikes)
+
+        return spikes
+
     def forward(self,input):
+        if self.step_mode == 'm':
+            return self.multi_step_forward(input)
+
         x = input/self.q_threshold
         if (not torch.is_tensor(x)) and x == 0.0 and (not torch.is_tensor(self.cur_output)) and self.cur_output == 0.0:
             self.is_work = False
             return x
         
         if not torch.is_tensor(self.cur_output):
-            self.cur_output = torch.zeros(x.shape,dtype=x.dtype).to(x.device)
-            self.acc_q = torch.zeros(x.shape,dtype=torch.float32).to(x.device)
-            self.q = torch.zeros(x.shape,dtype=torch.float32).to(x.device) + 0.5
+            self.init_state(x.shape,x.dtype,x.device)
 
         self.is_work = True
-        
-        self.q = self.q + (x.detach() if torch.is_tensor(x) else x)
-        self.acc_q = torch.round(self.acc_q)
-
-        spike_position = (self.q - 1 >= 0)
-        # neg_spike_position = (self.q < -self.eps) & (self.acc_q > self.neg_min)
 
-        self.cur_output[:] = 0
-        self.cur_output[spike_position] = 1
-        # self.cur_output[neg_spike_position] = -1
-
-        self.acc_q = self.acc_q + self.cur_output
-        self.q[spike_position] = self.q[spike_position] - 1
-        # self.q[neg_spike_position] = self.q[neg_spike_position] + 1
+        # no upper bound and no negative spikes for the original IF neuron
+        st_bif_step(x.detach() if torch.is_tensor(x) else x, self.q, self.acc_q, self.cur_output)
 
         # print((x == 0).all(), (self.cur_output==0).all())
         if (x == 0).all() and (self.cur_output==0).all():
@@ -93,12 +246,28 @@ class IFNeuron(nn.Module):
             self.neg_min = torch.tensor(0)
             
         self.eps = 0
+        # 's': one timestep per call, 'm': input is [T, B, ...] and all T steps run in one call
+        self.step_mode = 's'
+        # compact state: acc_q in the smallest integer type holding [neg_min, pos_max] and
+        # cur_output in int8; the residual q stays float32, it integrates real-valued inputs
+        self.compact_state = False
+        # persistent state: keep the state tensors of the first batch and zero them in place on
+        # reset, reallocating only when the batch shape changes
+        self.persistent_state = False
+        self.state_pool = None
+        # shared activity flag of SNNWrapper, replaces is_work when set
+        self.activity = None
 
     # def __repr__(self):
     #         return f"IFNeuron(level={self.level}, sym={self.sym}, pos_max={self.pos_max}, neg_min={self.neg_min}, q_threshold={self.q_threshold})"
     
     def reset(self):
         # print("IFNeuron reset")
+        if self.persistent_state and self.state_pool is not None:
+            q, acc_q, cur_output = self.state_pool
+            q.fill_(0.5)
+            acc_q.zero_()
+            cur_output.zero_()
         self.q = 0.0
         self.cur_output = 0.0
         self.acc_q = 0.0
@@ -106,81 +275,257 @@ class IFNeuron(nn.Module):
         self.spike_position = None
         self.neg_spike_position = None
 
+    def compact(self,index):
+        self.q = compact_batch(self.q,index)
+        self.acc_q = compact_batch(self.acc_q,index)
+        self.cur_output = compact_batch(self.cur_output,index)
+
+    def init_state(self,shape,dtype,device):
+        if self.persistent_state and self.state_pool is not None:
+            q, acc_q, cur_output = self.state_pool
+            if cur_output.shape == shape and cur_output.device == device and (self.compact_state or cur_output.dtype == dtype):
+                self.q, self.acc_q, self.cur_output = q, acc_q, cur_output
+                return
+        self.allocate_state(shape,dtype,device)
+        if self.persistent_state:
+            self.state_pool = (self.q, self.acc_q, self.cur_output)
+
+    def allocate_state(self,shape,dtype,device):
+        if self.compact_state:
+            self.cur_output = torch.zeros(shape,dtype=torch.int8,device=device)
+            self.acc_q = torch.zeros(shape,dtype=smallest_int_dtype(int(self.neg_min),int(self.pos_max)),device=device)
+            self.q = torch.full(shape,0.5,dtype=torch.float32,device=device)
+        else:
+            self.cur_output = torch.zeros(shape,dtype=dtype,device=device)
+            self.acc_q = torch.zeros(shape,dtype=torch.float32,device=device)
+            self.q = torch.full(shape,0.5,dtype=torch.float32,device=device)
+
+    def multi_step_forward(self,x_seq):
+        x_seq = x_seq.detach()
+        if not torch.is_tensor(self.cur_output):
+            self.init_state(x_seq.shape[1:],x_seq.dtype,x_seq.device)
+
+        spikes = st_bif_multistep(x_seq, self.q_threshold, self.q, self.acc_q, self.cur_output,
+                                  pos_max=self.pos_max, neg_min=self.neg_min, eps=self.eps)
+
+        # the finish check covers all T steps, not only the last one
+        if self.activity is not None:
+            mark_activity(self.activity, x_seq.transpose(0,1), spikes.transpose(0,1))
+        else:
+            self.is_work = multistep_work(x_seq, spikes)
+
+        return spikes
+
+    def forward_slices(self,input,index,shape):
+        '''
+        Single step on the slices `index` of a [B, H, ...] input of the given full shape, seen as
+        [B*H, ...]; input holds those slices only. The other slices must get zero input and must
+        not have fired at the previous step, so they stay silent and their state is unchanged.
+        Returns the spikes of the given slices.
+        '''
+        x = input/self.q_threshold
+        if not torch.is_tensor(self.cur_output):
+            self.init_state(shape,x.dtype,x.device)
+        self.is_work = True
+
+        state = [gather_slices(t,index) for t in (self.q,self.acc_q,self.cur_output)]
+        # the first len(index) slices of the full-shape scratch masks
+        masks = tuple(m.view((-1,)+m.shape[2:])[:index.numel()] for m in mask_buffers(self.cur_output))
+        st_bif_step(x.detach(), *state, pos_max=self.pos_max, neg_min=self.neg_min, eps=self.eps, masks=masks)
+        for t, slices in zip((self.q,self.acc_q,self.cur_output),state):
+            scatter_slices(t,index,slices)
+        cur_output = state[2]
+
+        work = x.flatten(1).ne(0).any(1).logical_or_(cur_output.flatten(1).ne(0).any(1))
+        if self.activity is not None:
+            flags = torch.zeros(shape[0]*shape[1],dtype=torch.bool,device=x.device).index_copy_(0,index,work)
+            mark_activity(self.activity, flags.view(shape[0],shape[1]))
+        elif not work.any():
+            self.is_work = False
+
+        if self.compact_state:
+            return cur_output.to(x.dtype).mul_(self.q_threshold)
+        return cur_output*self.q_threshold
+
     def forward(self,input):
+        if self.step_mode == 'm':
+            return self.multi_step_forward(input)
+
         x = input/self.q_threshold
         if (not torch.is_tensor(x)) and x == 0.0 and (not torch.is_tensor(self.cur_output)) and self.cur_output == 0.0:
             self.is_work = False
             return x*self.q_threshold
         
         if not torch.is_tensor(self.cur_output):
-            self.cur_output = torch.zeros(x.shape,dtype=x.dtype).to(x.device)
-            self.acc_q = torch.zeros(x.shape,dtype=torch.float32).to(x.device)
-            self.q = torch.zeros(x.shape,dtype=torch.float32).to(x.device) + 0.5
+            self.init_state(x.shape,x.dtype,x.device)
 
         self.is_work = True
-        
-        self.q = self.q + (x.detach() if torch.is_tensor(x) else x)
-        self.acc_q = torch.round(self.acc_q)
 
-        spike_position = (self.q - 1 >= 0) & (self.acc_q < self.pos_max)
-        neg_spike_position = (self.q < -self.eps) & (self.acc_q > self.neg_min)
-
-        self.cur_output[:] = 0
-        self.cur_output[spike_position] = 1
-        self.cur_output[neg_spike_position] = -1
-
-        self.acc_q = self.acc_q + self.cur_output
-        self.q[spike_position] = self.q[spike_position] - 1
-        self.q[neg_spike_position] = self.q[neg_spike_position] + 1
+        st_bif_step(x.detach() if torch.is_tensor(x) else x, self.q, self.acc_q, self.cur_output,
+                    pos_max=self.pos_max, neg_min=self.neg_min, eps=self.eps)
 
         # print((x == 0).all(), (self.cur_output==0).all())
-        if (x == 0).all() and (self.cur_output==0).all():
+        if self.activity is not None:
+            mark_activity(self.activity, x, self.cur_output)
+        elif (x == 0).all() and (self.cur_output==0).all():
             self.is_work = False
         
         # print("self.cur_output",self.cur_output)
-        
+
+        if self.compact_state:
+            return self.cur_output.to(x.dtype).mul_(self.q_threshold)
         return self.cur_output*self.q_threshold
 
 
+def persistent_buffer(buffer,like):
+    # reuse a zeroed state buffer when it still matches the batch, otherwise allocate a new one
+    if buffer is not None and buffer.shape == like.shape and buffer.dtype == like.dtype and buffer.device == like.device:
+        return buffer
+    return torch.zeros_like(like)
+
+
 class Spiking_LayerNorm(nn.Module):
     def __init__(self,dim):
         super(Spiking_LayerNorm, self).__init__()
         self.layernorm = nn.LayerNorm(dim)
         self.X = 0.0
         self.Y_pre = None
+        self.persistent_state = False
+        self.X_buffer = None
+        # only normalize the rows (tokens) whose input changed; the others output exact zeros
+        self.skip_unchanged_rows = False
+        # shared activity flag of SNNWrapper; without it is_work is only tracked with skip_unchanged_rows,
+        # which knows the active rows anyway
+        self.activity = None
+        self.is_work = False
 
     def reset(self):
         # print("Spiking_LayerNorm reset")
+        if self.persistent_state and self.X_buffer is not None:
+            self.X_buffer.zero_()
         self.X = 0.0
         self.Y_pre = None
+        self.is_work = False
         
+    def compact(self,index):
+        self.X = compact_batch(self.X,index)
+        self.Y_pre = compact_batch(self.Y_pre,index)
+
     def forward(self,input):
-        self.X = self.X + input
-        Y = self.layernorm(self.X)
-        if self.Y_pre is not None:
-            Y_pre = self.Y_pre.detach().clone()
+        if self.persistent_state:
+            if not torch.is_tensor(self.X):
+                self.X = persistent_buffer(self.X_buffer,input)
+                self.X_buffer = self.X
+            self.X.add_(input)
+        elif torch.is_tensor(self.X):
+            self.X.add_(input)
         else:
-            Y_pre = 0.0
+            self.X = self.X + input
+        if self.activity is not None:
+            mark_activity(self.activity, input)
+
+        if self.Y_pre is None:
+            # first step: Y - 0
+            Y = self.layernorm(self.X)
+            self.Y_pre = Y
+            return Y.clone()
+
+        if self.skip_unchanged_rows:
+            C = input.shape[-1]
+            rows = input.reshape(-1,C).ne(0).any(-1).nonzero().squeeze(1)
+            self.is_work = rows.numel() > 0
+            if not self.is_work:
+                return shared_zeros(self.Y_pre.shape,self.Y_pre.dtype,self.Y_pre.device)
+            Y_pre = self.Y_pre.view(-1,C)
+            Y = self.layernorm(self.X.reshape(-1,C).index_select(0,rows))
+            output = torch.zeros_like(self.Y_pre)
+            output.view(-1,C).index_copy_(0,rows,Y - Y_pre.index_select(0,rows))
+            Y_pre.index_copy_(0,rows,Y)
+            return output
+
+        # Y - Y_pre written into the Y_pre buffer, Y becomes the new Y_pre
+        Y = self.layernorm(self.X)
+        output = self.Y_pre.neg_().add_(Y)
         self.Y_pre = Y
-        return Y - Y_pre
+        return output
 
 class spiking_softmax(nn.Module):
     def __init__(self):
         super(spiking_softmax, self).__init__()
         self.X = 0.0
         self.Y_pre = 0.0
+        self.persistent_state = False
+        self.X_buffer = None
+        # only recompute the softmax of the rows whose input changed; the others output exact zeros
+        self.skip_unchanged_rows = False
     
     def reset(self):
         # print("spiking_softmax reset")
+        if self.persistent_state and self.X_buffer is not None:
+            self.X_buffer.zero_()
         self.X = 0.0
         self.Y_pre = 0.0        
     
+    def compact(self,index):
+        self.X = compact_batch(self.X,index)
+        self.Y_pre = compact_batch(self.Y_pre,index)
+
     def forward(self, input):
-        self.X = input + self.X
+        if self.persistent_state:
+            if not torch.is_tensor(self.X):
+                self.X = persistent_buffer(self.X_buffer,input)
+                self.X_buffer = self.X
+            self.X.add_(input)
+        elif torch.is_tensor(self.X):
+            self.X.add_(input)
+        else:
+            self.X = input + self.X
+
+        if not torch.is_tensor(self.Y_pre):
+            # first step: Y - 0
+            Y = F.softmax(self.X,dim=-1)
+            self.Y_pre = Y
+            return Y.clone()
+
+        if self.skip_unchanged_rows:
+            # a row whose input is zero keeps its softmax, so its output is exactly zero; only the
+            # changed rows are recomputed (in full: their normaliser moves every entry)
+            N = input.shape[-1]
+            rows = input.reshape(-1,N).ne(0).any(-1).nonzero().squeeze(1)
+            if rows.numel() == 0:
+                return shared_zeros(self.Y_pre.shape,self.Y_pre.dtype,self.Y_pre.device)
+            Y_pre = self.Y_pre.view(-1,N)
+            Y = F.softmax(self.X.reshape(-1,N).index_select(0,rows),dim=-1)
+            output = torch.zeros_like(self.Y_pre)
+            output.view(-1,N).index_copy_(0,rows,Y - Y_pre.index_select(0,rows))
+            Y_pre.index_copy_(0,rows,Y)
+            return output
+
+        # Y - Y_pre written into the Y_pre buffer, which is handed to the caller; Y becomes the
+        # new Y_pre, so nothing is copied
         Y = F.softmax(self.X,dim=-1)
-        Y_pre = deepcopy(self.Y_pre)
+        output = self.Y_pre.neg_().add_(Y)
         self.Y_pre = Y
-        return Y - Y_pre
+        return output
+
+    def forward_slices(self,input,index,shape):
+        # forward() on the slices `index` of the [B*H, N, N] map; the other slices get zero input,
+        # so their softmax is unchanged
+        if not torch.is_tensor(self.X):
+            X = self.X_buffer if self.persistent_state else None
+            if X is None or X.shape != shape or X.dtype != input.dtype or X.device != input.device:
+                X = torch.zeros(shape,dtype=input.dtype,device=input.device)
+            self.X = X
+            if self.persistent_state:
+                self.X_buffer = X
+        if not torch.is_tensor(self.Y_pre):
+            self.Y_pre = torch.zeros(shape,dtype=input.dtype,device=input.device)
+        X = gather_slices(self.X,index) + input
+        scatter_slices(self.X,index,X)
+        Y = F.softmax(X,dim=-1)
+        Y_pre = gather_slices(self.Y_pre,index)
+        scatter_slices(self.Y_pre,index,Y)
+        return Y_pre.neg_().add_(Y)
 
 def grad_scale(x, scale):
     y = x
@@ -197,6 +542,36 @@ def round_pass(x):
     y_grad = x
     return (y - y_grad).detach() + y_grad
 
+class LSQFakeQuant(torch.autograd.Function):
+    '''
+    clamp(floor(x/s + 0.5), min_val, max_val)*s in one autograd node, the forward of MyQuan.
+    Only x and s are saved; backward recomputes the clip mask and returns the straight-through
+    gradient of x and the LSQ gradient of s (times grad_scale) that the grad_scale/floor_pass
+    chain gives, including torch.clamp's tensor-bound convention of half the gradient on a bound.
+    '''
+    @staticmethod
+    def forward(ctx, x, s, min_val, max_val, grad_scale):
+        ctx.save_for_backward(x, s, min_val, max_val)
+        ctx.grad_scale = grad_scale
+        return torch.clamp(torch.floor(x/s + 0.5), min=min_val, max=max_val)*s
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, s, min_val, max_val = ctx.saved_tensors
+        x_s = x/s
+        q = torch.floor(x_s + 0.5)
+        clipped = torch.clamp(q, min=min_val, max=max_val)
+        # d clipped / d q: 1 inside the range, 1/2 on a bound, 0 outside
+        pass_through = (clipped == q).to(x.dtype)
+        pass_through.masked_fill_((q == min_val) | (q == max_val), 0.5)
+        grad_x = grad_output*pass_through if ctx.needs_input_grad[0] else None
+        grad_s = None
+        if ctx.needs_input_grad[1]:
+            # d output / d s = clipped - pass_through*x/s: the rounding error inside the range, the bound outside
+            grad_s = torch.sum(grad_output*(clipped - pass_through*x_s), dtype=s.dtype)
+            grad_s = (grad_s*ctx.grad_scale).reshape(s.shape)
+        return grad_x, grad_s, None, None, None
+
 def threshold_optimization(data, quantization_level=255, n_trial=300, eps=1e-10):
     '''
     This function collect the activation data and find the optimized clipping
@@ -204,62 +579,148 @@ def threshold_optimization(data, quantization_level=255, n_trial=300, eps=1e-10)
     post-training quantization which adopted in Tensor-RT, we keep the number of
     bits here.
     Args:
-        data(numpy array): activation data
+        data(numpy array or tensor): activation data
         n_bit(int):
         n_trial(int): the searching steps.
         eps(float): add eps at the average bin step for numberical stability.
 
     '''
-
-    n_lvl = quantization_level  # quantization levels
-    n_half_lvls = (quantization_level)//2
-    n_bin_edge = n_lvl * n_trial + 1
-
-    data_max = np.max(np.abs(data))
-    hist, bin_edge = np.histogram(data.flatten(),
-                                  bins=np.linspace(-data_max,
-                                                   data_max,
-                                                   num=n_bin_edge))
-
-    mid_idx = int((len(hist)) / 2)
-    start_idx = 100
-    # log the threshold and corresponding KL-divergence
-    kl_result = np.empty([len(range(start_idx, n_trial + 1)), 2])
-
-    for i in range(start_idx, n_trial + 1):
-        ref_dist = np.copy(hist[mid_idx - i * n_half_lvls:mid_idx +
-                                i * n_half_lvls])
-        # merge the outlier
-        ref_dist[0] += hist[:mid_idx - i * n_half_lvls].sum()
-        ref_dist[-1] += hist[mid_idx + i * n_half_lvls:].sum()
-        # perform quantization: bins merge and expansion
-        reshape_dim = int(len(ref_dist) / n_lvl)
-        ref_dist_reshape = ref_dist.reshape(n_lvl, i)
-        # merge bins for quantization
-        ref_dist_merged = ref_dist_reshape.sum(axis=1)
-        nonzero_mask = (ref_dist_reshape != 0
-                        )  # obtain the mask of non-zero bins
-        # in each merged large bin, get the average bin_count
-        average_bin_count = ref_dist_merged / (nonzero_mask.sum(1) + eps)
-        # expand the merged bins back
-        expand_bin_count = np.expand_dims(average_bin_count,
-                                          axis=1).repeat(i, axis=1)
-        candidate_dist = (nonzero_mask * expand_bin_count).flatten()
-        kl_div = scipy.stats.entropy(candidate_dist / candidate_dist.sum(),
-                                     ref_dist / ref_dist.sum())
-        #log threshold and KL-divergence
-        current_th = np.abs(
-            bin_edge[mid_idx - i * n_half_lvls])  # obtain current threshold
-        kl_result[i -
-                  start_idx, 0], kl_result[i -
-                                           start_idx, 1] = current_th, kl_div
-
-    # based on the logged kl-div result, find the threshold correspond to the smallest kl-div
-    th_sel = kl_result[kl_result[:, 1] == kl_result[:, 1].min()][0, 0]
+    calibrator = KLCalibrator(quantization_level=quantization_level, n_trial=n_trial, eps=eps)
+    calibrator.update(torch.as_tensor(data))
+    th_sel = calibrator.compute()
     print(f"Threshold calibration of current layer finished!, calculate threshold {th_sel}")
 
     return th_sel
 
+class HistogramCalibrator():
+    '''
+    Activation histogram for threshold calibration, accumulated on the device of the data over
+    any number of batches by update(): one fixed layout of quantization_level*n_trial bins over
+    [-data_max, data_max], where data_max is the largest |x| of the first batch and doubles (bin
+    pairs are merged) when a later batch exceeds it. Subclasses pick the clipping threshold in
+    compute(); a quantizer with quantization_level levels over [-threshold, threshold] then has the
+    step 2*threshold/quantization_level.
+    '''
+    def __init__(self, quantization_level=255, n_trial=300):
+        self.n_lvl = quantization_level
+        self.n_half_lvls = quantization_level//2
+        self.n_trial = n_trial
+        self.n_bin = quantization_level*n_trial
+        assert self.n_bin % 4 == 0, "quantization_level*n_trial must be a multiple of 4"
+        self.hist = None
+        self.data_max = None
+
+    @torch.no_grad()
+    def update(self, x):
+        x = x.detach().float()
+        data_max = x.abs().max().item()
+        if self.hist is None:
+            self.data_max = max(data_max, 1e-12)
+            self.hist = torch.zeros(self.n_bin, dtype=torch.float64, device=x.device)
+        while data_max > self.data_max:
+            # [-2*data_max, 2*data_max]: bin pairs merged into the middle half
+            pad = self.n_bin//4
+            self.hist = F.pad(self.hist.view(-1,2).sum(1), (pad,pad))
+            self.data_max = self.data_max*2
+        self.hist += torch.histc(x, bins=self.n_bin, min=-self.data_max, max=self.data_max)
+
+    def bin_width(self):
+        return 2*self.data_max/self.n_bin
+
+    def compute(self):
+        raise NotImplementedError
+
+class KLCalibrator(HistogramCalibrator):
+    '''
+    Multi-batch, on-device form of the KL threshold search of threshold_optimization: compute()
+    evaluates the KL divergence of all candidate thresholds at once from prefix sums of the
+    histogram.
+    '''
+    def __init__(self, quantization_level=255, n_trial=300, start_idx=100, eps=1e-10):
+        super(KLCalibrator, self).__init__(quantization_level, n_trial)
+        self.start_idx = start_idx
+        self.eps = eps
+
+    @torch.no_grad()
+    def compute(self):
+        hist = self.hist
+        h = self.n_half_lvls
+        mid = self.n_bin//2
+        # candidate i: window hist[mid - i*h : mid + i*h] quantized into 2*h bins of i fine bins,
+        # the outliers merged into its first and last fine bin
+        i = torch.arange(self.start_idx, self.n_trial + 1, device=hist.device)
+        lo, hi = mid - i*h, mid + i*h
+        edges = lo[:,None] + torch.arange(2*h + 1, device=hist.device)[None,:]*i[:,None]
+
+        def window_sums(values):
+            prefix = F.pad(values.cumsum(0), (1,0))
+            return prefix[edges[:,1:]] - prefix[edges[:,:-1]], prefix
+
+        nonzero = hist > 0
+        log_hist = torch.where(nonzero, hist, 1.0).log()
+        merged, prefix = window_sums(hist)
+        count, _ = window_sums(nonzero.double())
+        log_sum, _ = window_sums(log_hist)
+        total = prefix[-1]
+        for end, bin, outliers in ((0, lo, prefix[lo]), (-1, hi - 1, total - prefix[hi])):
+            old, new = hist[bin], hist[bin] + outliers
+            merged[:,end] += outliers
+            count[:,end] += (old == 0) & (new > 0)
+            log_sum[:,end] += torch.where(new > 0, new, 1.0).log() - log_hist[bin]
+
+        # KL(p || q) with p the expanded average of every quantization bin on the non-zero fine
+        # bins and q the window itself, both normalized (scipy.stats.entropy)
+        average = merged/(count + self.eps)
+        p = average/(average*count).sum(1, keepdim=True)
+        kl = torch.where(count > 0, p*(count*p.log() - log_sum + count*total.log()), 0.0).sum(1)
+        # first candidate of the smallest divergence, threshold |bin_edge[lo]|
+        th_sel = (i[torch.argmin(kl)]*h).item()*self.bin_width()
+        return th_sel
+
+class PercentileCalibrator(HistogramCalibrator):
+    '''
+    Clip at the given percentile of |x|, or of the positive x for an unsigned quantizer.
+    '''
+    def __init__(self, quantization_level=255, n_trial=300, percentile=99.99, unsigned=False):
+        super(PercentileCalibrator, self).__init__(quantization_level, n_trial)
+        self.percentile = percentile
+        self.unsigned = unsigned
+
+    @torch.no_grad()
+    def compute(self):
+        mid = self.n_bin//2
+        folded = self.hist[mid:] if self.unsigned else self.hist[mid:] + self.hist[:mid].flip(0)
+        cumulative = folded.cumsum(0)
+        index = torch.searchsorted(cumulative, cumulative[-1]*self.percentile/100)
+        # upper edge of the bin holding the percentile
+        return (index.clamp(max=mid - 1).item() + 1)*self.bin_width()
+
+class MSECalibrator(HistogramCalibrator):
+    '''
+    Clip at the threshold whose quantizer clamp(floor(x/s + 0.5), neg_min, pos_max)*s, with
+    s = 2*threshold/quantization_level, has the smallest squared error over the histogram (bins
+    taken at their centers). The candidates are the multiples of data_max/n_trial, evaluated
+    chunk at a time.
+    '''
+    def __init__(self, quantization_level=255, n_trial=300, neg_min=None, pos_max=None, chunk=32):
+        super(MSECalibrator, self).__init__(quantization_level, n_trial)
+        self.neg_min = -self.n_half_lvls if neg_min is None else neg_min
+        self.pos_max = self.n_half_lvls - 1 if pos_max is None else pos_max
+        self.chunk = chunk
+
+    @torch.no_grad()
+    def compute(self):
+        index = self.hist.nonzero().squeeze(1)
+        counts = self.hist[index]
+        centers = (index.double() + 0.5)*self.bin_width() - self.data_max
+        thresholds = torch.arange(1, self.n_trial + 1, dtype=torch.float64, device=counts.device)*self.data_max/self.n_trial
+        errors = []
+        for start in range(0, self.n_trial, self.chunk):
+            s = (2*thresholds[start:start+self.chunk]/self.n_lvl)[:,None]
+            quantized = torch.clamp(torch.floor(centers/s + 0.5), min=self.neg_min, max=self.pos_max)*s
+            errors.append(((quantized - centers)**2*counts).sum(1))
+        return thresholds[torch.argmin(torch.cat(errors))].item()
+
 # class MyQuan(nn.Module):
 #     def __init__(self,level,sym = False,**kwargs):
 #         super(MyQuan,self).__init__()
@@ -434,9 +895,10 @@ class MyQuan(nn.Module):
         #     self.init_state += 1
         #     # print("initialize finish!!!!")
 
-        s_scale = grad_scale(self.s, s_grad_scale)
-        # s_scale = s_scale * ((self.level_init)/(self.pos_max))
-        output = torch.clamp(floor_pass(x/s_scale + 0.5), min=min_val, max=max_val)*s_scale
+        # s_scale = grad_scale(self.s, s_grad_scale)
+        # output = torch.clamp(floor_pass(x/s_scale + 0.5), min=min_val, max=max_val)*s_scale
+        s_scale = self.s
+        output = LSQFakeQuant.apply(x, s_scale, min_val, max_val, s_grad_scale)
 
         if self.debug and self.tfwriter is not None:
             self.tfwriter.add_histogram(tag="before_quan/".format(s_scale.item())+self.name+'_data', values=(x).detach().cpu(), global_step=self.global_step)
@@ -451,6 +913,18 @@ class MyQuan(nn.Module):
         # output = floor_pass(x/s_scale)*s_scale
         return output
 
+def chunked_attention(q,k,v,attn_fn,chunk):
+    '''
+    attn_fn(q @ k^T) @ v evaluated over blocks of `chunk` query rows, so at most a chunk x N slice
+    of the N x N attention map exists at a time. Exact for any attn_fn that works on each row of
+    the map on its own (elementwise ops, quantizers, softmax over the keys).
+    '''
+    kT = k.transpose(-2, -1)
+    output = []
+    for start in range(0,q.shape[-2],chunk):
+        output.append(attn_fn(q[...,start:start+chunk,:] @ kT) @ v)
+    return torch.cat(output,dim=-2)
+
 class QAttention(nn.Module):
 
     def __init__(
@@ -485,7 +959,21 @@ class QAttention(nn.Module):
         self.proj_drop = nn.Dropout(proj_drop)
         self.attn_quan = MyQuan(self.level,sym=False)
         self.after_attn_quan = MyQuan(self.level,sym=True)
+        # > 0: evaluate the attention over blocks of attention_chunk query rows (eval only, MyQuan
+        # scales its gradient by the number of elements it sees)
+        self.attention_chunk = 0
+        
+    def attention_map(self, attn, N):
+        if self.is_softmax:
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_quan(attn)
+        else:
+            # print("no softmax!!!!")
+            attn = self.attn_quan(attn)/N
         
+        attn = self.attn_drop(attn)
+        return attn
+
     def forward(self, x):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
@@ -495,16 +983,12 @@ class QAttention(nn.Module):
         k = self.quan_k(k)
         v = self.quan_v(v)
         q = q * self.scale
-        attn = q @ k.transpose(-2, -1)
-        if self.is_softmax:
-            attn = attn.softmax(dim=-1)
-            attn = self.attn_quan(attn)
+        if self.attention_chunk > 0 and not self.training:
+            x = chunked_attention(q, k, v, lambda attn: self.attention_map(attn, N), self.attention_chunk)
         else:
-            # print("no softmax!!!!")
-            attn = self.attn_quan(attn)/N
-        
-        attn = self.attn_drop(attn)
-        x = attn @ v
+            attn = q @ k.transpose(-2, -1)
+            attn = self.attention_map(attn, N)
+            x = attn @ v
         x = self.after_attn_quan(x)
 
         x = x.transpose(1, 2).reshape(B, N, C)
@@ -520,6 +1004,19 @@ def multi(x1_t,x2_t,x1_sum_t,x2_sum_t):
 def multi1(x1_t,x2_t,x1_sum_t,x2_sum_t):
     return x1_sum_t @ x2_t + x1_t @ x2_sum_t - x1_t @ x2_t
 
+def incremental_matmul(x1_t,x2_t,x1_acc,x2_acc):
+    '''
+    Step t increment of the running product (sum_s x1_s) @ (sum_s x2_s) in two matmuls:
+        X1_{<=t} @ X2_{<=t} - X1_{<t} @ X2_{<t} = x1_t @ X2_{<=t} + X1_{<t} @ x2_t
+    which is what multi()/multi1() compute with three. On entry x1_acc/x2_acc hold X1_{<t}/X2_{<t};
+    both are advanced to step t in place.
+    '''
+    x2_acc.add_(x2_t)
+    output = x1_t @ x2_acc
+    output += x1_acc @ x2_t
+    x1_acc.add_(x1_t)
+    return output
+
 class SAttention(nn.Module):
 
     def __init__(
@@ -559,6 +1056,29 @@ class SAttention(nn.Module):
         if self.is_softmax:
             self.Ssoftmax = spiking_softmax()
         self.T = 0
+        # running sums of the scaled q, k^T, attention and v spikes for incremental_matmul
+        self.q_acc = None
+        self.kT_acc = None
+        self.attn_acc = None
+        self.v_acc = None
+        self.persistent_state = False
+        # head-level skipping: only update the (batch, head) slices that can change this step;
+        # heads_fired marks the slices whose attn_IF/after_attn_IF fired at the previous step
+        self.head_skip = False
+        self.heads_fired = None
+        self.head_steps = 0
+        self.head_skipped = 0
+
+    def running_sum(self,name,shape,device):
+        acc = getattr(self,name)
+        if acc is None or acc.shape != shape or acc.device != device:
+            acc = torch.zeros(shape,dtype=torch.float32,device=device)
+            setattr(self,name,acc)
+        return acc
+
+    def head_activity_stats(self):
+        return {"head_steps": self.head_steps, "head_skipped": self.head_skipped,
+                "skip_rate": self.head_skipped / max(self.head_steps, 1)}
 
     def reset(self):
         # print("SAttention reset")
@@ -573,6 +1093,58 @@ class SAttention(nn.Module):
         self.qkv.reset()
         self.proj.reset()
         self.T = 0
+        self.heads_fired = None
+        for name in ("q_acc","kT_acc","attn_acc","v_acc"):
+            if self.persistent_state and getattr(self,name) is not None:
+                getattr(self,name).zero_()
+            else:
+                setattr(self,name,None)
+
+    def compact(self,index):
+        # the neurons/linears are compacted on their own
+        for name in ("q_acc","kT_acc","attn_acc","v_acc","heads_fired"):
+            setattr(self,name,compact_batch(getattr(self,name),index))
+
+    def forward_active_heads(self,q,kT,v,N):
+        # A slice without q/k/v spikes whose attn_IF and after_attn_IF stayed silent at the previous
+        # step adds exact zeros to both products and its neurons stay silent, so it is skipped: the
+        # matmuls and neurons run on the gathered active slices only. The spiking softmax is not
+        # zero on zero input: its first step emits softmax(0) = 1/N for every slice, so with the
+        # softmax every slice is active until its state is initialised.
+        B, H = q.shape[:2]
+        active = q.flatten(2).ne(0).any(-1) | kT.flatten(2).ne(0).any(-1) | v.flatten(2).ne(0).any(-1)
+        if self.is_softmax and not torch.is_tensor(self.Ssoftmax.Y_pre):
+            active.fill_(True)
+        if self.heads_fired is not None:
+            active.logical_or_(self.heads_fired)
+        index = active.view(-1).nonzero().squeeze(1)
+        self.head_steps += B*H
+        self.head_skipped += B*H - index.numel()
+
+        q_acc = self.running_sum("q_acc",q.shape,q.device)
+        kT_acc = self.running_sum("kT_acc",kT.shape,q.device)
+        attn_acc = self.running_sum("attn_acc",(B,H,N,N),q.device)
+        v_acc = self.running_sum("v_acc",v.shape,q.device)
+        accs = [gather_slices(acc,index) for acc in (q_acc,kT_acc,attn_acc,v_acc)]
+        v = gather_slices(v,index)
+
+        attn = incremental_matmul(gather_slices(q,index),gather_slices(kT,index),accs[0],accs[1])
+        if self.is_softmax:
+            attn = self.Ssoftmax.forward_slices(attn,index,(B,H,N,N))
+        attn = self.attn_IF.forward_slices(attn,index,(B,H,N,N))
+        fired = attn.flatten(1).ne(0).any(1)
+        if not self.is_softmax:
+            attn = attn/N
+        attn = self.attn_drop(attn)
+
+        x = incremental_matmul(attn,v,accs[2],accs[3])
+        x = self.after_attn_IF.forward_slices(x,index,(B,H)+v.shape[1:])
+        fired.logical_or_(x.flatten(1).ne(0).any(1))
+
+        for acc, slices in zip((q_acc,kT_acc,attn_acc,v_acc),accs):
+            scatter_slices(acc,index,slices)
+        self.heads_fired = torch.zeros(B*H,dtype=torch.bool,device=q.device).index_copy_(0,index,fired).view(B,H)
+        return x.new_zeros((B*H,)+x.shape[1:]).index_copy_(0,index,x).view((B,H)+x.shape[1:])
 
     def forward(self, x):
         B, N, C = x.shape
@@ -585,25 +1157,24 @@ class SAttention(nn.Module):
         v = self.v_IF(v)
         
         q = q * self.scale
-        q_acc = self.q_IF.acc_q * self.scale * self.q_IF.q_threshold
-        attn = multi(q,k,q_acc.float(),(self.k_IF.acc_q*self.k_IF.q_threshold).float())
+        kT = k.transpose(-2, -1)
+        if self.head_skip:
+            x = self.forward_active_heads(q,kT,v,N)
+        else:
+            attn = incremental_matmul(q,kT,self.running_sum("q_acc",q.shape,q.device),self.running_sum("kT_acc",kT.shape,kT.device))
 
-        if self.is_softmax:
-            attn = self.Ssoftmax(attn)
+            if self.is_softmax:
+                attn = self.Ssoftmax(attn)
 
-        attn = self.attn_IF(attn)
-        if not self.is_softmax:
-            attn = attn/N
-            acc_attn = self.attn_IF.acc_q*self.attn_IF.q_threshold/N
+            attn = self.attn_IF(attn)
+            if not self.is_softmax:
+                attn = attn/N
 
-        attn = self.attn_drop(attn)
+            attn = self.attn_drop(attn)
 
-        if not self.is_softmax:
-            x = multi1(attn,v,(acc_attn).float(),(self.v_IF.acc_q*self.v_IF.q_threshold).float())
-        else:
-            x = multi1(attn,v,(self.attn_IF.acc_q*self.attn_IF.q_threshold).float(),(self.v_IF.acc_q*self.v_IF.q_threshold).float())
+            x = incremental_matmul(attn,v,self.running_sum("attn_acc",attn.shape,attn.device),self.running_sum("v_acc",v.shape,v.device))
 
-        x = self.after_attn_IF(x)
+            x = self.after_attn_IF(x)
 
         x = x.transpose(1, 2).reshape(B, N, C)
 
@@ -626,6 +1197,9 @@ class SpikeMaxPooling(nn.Module):
     def reset(self):
         self.accumulation = None
 
+    def compact(self,index):
+        self.accumulation = compact_batch(self.accumulation,index)
+
     def forward(self,x):
         old_accu = self.accumulation
         if self.accumulation is None:
@@ -644,7 +1218,48 @@ class SpikeMaxPooling(nn.Module):
         return output
 
 
-class QuanConv2d(torch.nn.Conv2d):
+class FrozenQuanWeight():
+    '''
+    Weight quantization cache shared by QuanConv2d and QuanLinear. After freeze(), eval forwards
+    reuse quan_w_fn(weight) until train(), an updated or replaced weight or a changed step size of
+    quan_w_fn; freeze(drop_weight=True) also releases the float weight, leaving only the quantized
+    one (eval only from then on).
+    '''
+    def init_weight_cache(self):
+        self.frozen = False
+        self.register_buffer("weight_cache",None,persistent=False)
+        self.weight_cache_key = None
+
+    def quantized_weight(self):
+        if self.weight is None:
+            if self.training or self.weight_cache is None:
+                raise RuntimeError("the float weight was dropped by freeze(drop_weight=True)")
+            return self.weight_cache
+        if not self.frozen or self.training:
+            return self.quan_w_fn(self.weight)
+        s = self.quan_w_fn.s
+        key = (self.weight.data_ptr(),self.weight._version,s.data_ptr(),s._version)
+        if self.weight_cache is None or self.weight_cache_key != key:
+            with torch.no_grad():
+                self.weight_cache = self.quan_w_fn(self.weight)
+            self.weight_cache_key = key
+        return self.weight_cache
+
+    def freeze(self,drop_weight=False):
+        self.frozen = True
+        if drop_weight:
+            with torch.no_grad():
+                self.weight_cache = self.quan_w_fn(self.weight)
+            self.weight = None
+        return self
+
+    def train(self,mode=True):
+        if mode and self.weight is not None:
+            self.weight_cache = None
+            self.weight_cache_key = None
+        return super().train(mode)
+
+class QuanConv2d(FrozenQuanWeight, torch.nn.Conv2d):
     def __init__(self, m: torch.nn.Conv2d, quan_w_fn=None):
         assert type(m) == torch.nn.Conv2d
         super().__init__(m.in_channels, m.out_channels, m.kernel_size,
@@ -662,13 +1277,14 @@ class QuanConv2d(torch.nn.Conv2d):
             self.bias = torch.nn.Parameter(m.bias.detach())
         else:
             self.bias = None
+        self.init_weight_cache()
 
     def forward(self, x):
-        quantized_weight = self.quan_w_fn(self.weight)
+        quantized_weight = self.quantized_weight()
         return self._conv_forward(x, quantized_weight,self.bias)
 
 
-class QuanLinear(torch.nn.Linear):
+class QuanLinear(FrozenQuanWeight, torch.nn.Linear):
     def __init__(self, m: torch.nn.Linear, quan_w_fn=None):
         assert type(m) == torch.nn.Linear
         super().__init__(m.in_features, m.out_features,
@@ -679,9 +1295,10 @@ class QuanLinear(torch.nn.Linear):
         # self.quan_w_fn.init_from(m.weight)
         if m.bias is not None:
             self.bias = torch.nn.Parameter(m.bias.detach())
+        self.init_weight_cache()
 
     def forward(self, x):
-        quantized_weight = self.quan_w_fn(self.weight)
+        quantized_weight = self.quantized_weight()
         return torch.nn.functional.linear(x, quantized_weight, self.bias)
 
 
@@ -696,58 +1313,82 @@ class LLConv2d(nn.Module):
         self.level = kwargs["level"]
         self.steps = 1
         self.realize_time = self.steps
+        self.persistent_state = False
+        self.activity = None
+        self.input_shape = None
+        self.bias_step = None
+        self.bias_step_key = None
         
         
     def reset(self):
         # print("LLConv2d reset")
         self.is_work = False
         self.first = True
-        self.zero_output = None
+        if not self.persistent_state:
+            self.zero_output = None
         self.realize_time = self.steps
 
+    def compact(self,index):
+        self.zero_output = None
+
+    def step_bias(self):
+        # bias/steps, cached until the bias changes
+        bias = self.conv.bias
+        key = (bias.data_ptr(),bias._version,self.steps)
+        if self.bias_step_key != key:
+            self.bias_step = bias.detach()/self.steps
+            self.bias_step_key = key
+        return self.bias_step
+
     def forward(self,input):
         # print("LLConv2d.steps",self.steps)
         x = input
-        N,C,H,W = x.shape
-        F_h,F_w = self.conv.kernel_size
-        S_h,S_w = self.conv.stride
-        P_h,P_w = self.conv.padding
-        C = self.conv.out_channels
-        H = math.floor((H - F_h + 2*P_h)/S_h)+1
-        W = math.floor((W - F_w + 2*P_w)/S_w)+1
-
-        if self.zero_output is None:
+        if self.zero_output is None or self.input_shape != x.shape or self.zero_output.dtype != x.dtype or self.zero_output.device != x.device:
+            N,C,H,W = x.shape
+            F_h,F_w = self.conv.kernel_size
+            S_h,S_w = self.conv.stride
+            P_h,P_w = self.conv.padding
+            C = self.conv.out_channels
+            H = math.floor((H - F_h + 2*P_h)/S_h)+1
+            W = math.floor((W - F_w + 2*P_w)/S_w)+1
             # self.zero_output = 0.0
-            self.zero_output = torch.zeros(size=(N,C,H,W),device=x.device,dtype=x.dtype)
-
-        if (not torch.is_tensor(x) and (x == 0.0)) or ((x==0.0).all()):
+            self.input_shape = x.shape
+            self.zero_output = shared_zeros((N,C,H,W),x.dtype,x.device)
+
+        # Without a host sync the all-zero shortcut below cannot be taken, so the dense path runs
+        # instead. It gives the same result only for ST-BIF layers with a bias, which cancels
+        # outside the realizing step ((0 W + b) - b == 0); the other layers keep the synchronous check.
+        # A shared_zeros input (e.g. the encoder's zero steps) is known to be zero without a check.
+        sync_free = self.activity is not None and self.neuron_type != 'IF' and self.conv.bias is not None and not has_forward_hooks(self.conv)
+        if is_shared_zeros(x) or (not sync_free and ((not torch.is_tensor(x) and (x == 0.0)) or (not x.any()))):
             self.is_work = False
             if self.realize_time > 0:
-                output = self.zero_output + (self.conv.bias.data.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)/self.steps if self.conv.bias is not None else 0.0)
+                output = self.step_bias()[:,None,None].expand(self.zero_output.shape) if self.conv.bias is not None else self.zero_output
                 self.realize_time = self.realize_time - 1
                 self.is_work = True
+                if self.activity is not None:
+                    self.activity.fill_(True)
                 return output
             return self.zero_output
+        if sync_free:
+            if self.realize_time > 0:
+                self.activity.fill_(True)
+            else:
+                mark_activity(self.activity, x)
 
         output = self.conv(x)
-
-        if self.neuron_type == 'IF':
-            pass
-        else:
-            if self.conv.bias is None:
-                pass
-            else:
-                # if not self.first:
-                #     output = output - self.conv.bias.data.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-                output = output - (self.conv.bias.data.unsqueeze(0).unsqueeze(-1).unsqueeze(-1) if self.conv.bias is not None else 0.0)
-                if self.realize_time > 0:
-                    output = output + (self.conv.bias.data.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)/self.steps if self.conv.bias is not None else 0.0)
-                    self.realize_time = self.realize_time - 1
-                    # print("conv2d self.realize_time",self.realize_time)
-                    
+        if self.neuron_type != 'IF' and self.conv.bias is not None:
+            # the realized bias is not added again; bias/steps in the realizing steps
+            output.sub_(self.conv.bias.detach()[:,None,None])
+            if self.realize_time > 0:
+                output.add_(self.step_bias()[:,None,None])
+                self.realize_time = self.realize_time - 1
+                # print("conv2d self.realize_time",self.realize_time)
 
         self.is_work = True
         self.first = False
+        if self.activity is not None and not sync_free:
+            self.activity.fill_(True)
 
         return output
 
@@ -762,13 +1403,170 @@ class LLLinear(nn.Module):
         self.level = kwargs["level"]
         self.steps = 1
         self.realize_time = self.steps
+        self.persistent_state = False
+        self.activity = None
+        # event-driven mode: multiply only the rows (tokens) that carry spikes while the fraction of
+        # such rows is at most row_sparse_threshold; None calibrates it at the first sparse step
+        self.row_sparse = False
+        self.row_sparse_threshold = None
+        # CPU: accumulate the weight columns picked by ternary {-theta, 0, +theta} spike inputs
+        # instead of a float GEMM; weight_t caches the transposed weight it gathers from
+        self.spike_accumulate = False
+        self.weight_t = None
+        self.weight_t_key = None
+        self.bias_step = None
+        self.bias_step_key = None
+        # pruned weights: multiply with a CSR copy of the weight (weight_csr) instead of the dense one;
+        # calibrated at the first use, the CSR path is only kept where it beats the dense GEMM
+        self.sparse_weight = False
+        self.sparse_weight_faster = None
+        self.sparse_weight_key = None
+        self.weight_csr = None
+        self.weight_csr_key = None
     def reset(self):
         # print("LLLinear reset")
         self.is_work = False
         self.first = True
-        self.zero_output = None
+        if not self.persistent_state:
+            self.zero_output = None
         self.realize_time = self.steps
 
+    def compact(self,index):
+        self.zero_output = None
+
+    def effective_weight(self):
+        # the weight the layer multiplies with: the quantized one of a QuanLinear
+        return self.linear.quantized_weight() if isinstance(self.linear, QuanLinear) else self.linear.weight
+
+    def weight_key(self):
+        # identifies the values of effective_weight(): the float weight and, for a QuanLinear, its step size
+        tensors = [self.linear.weight]
+        if isinstance(self.linear, QuanLinear):
+            tensors.append(self.linear.quan_w_fn.s)
+            if self.linear.weight is None:
+                tensors[0] = self.linear.weight_cache
+        return tuple((t.data_ptr(),t._version) for t in tensors)
+
+    def step_bias(self):
+        # bias/steps, cached until the bias changes
+        bias = self.linear.bias
+        key = (bias.data_ptr(),bias._version,self.steps)
+        if self.bias_step_key != key:
+            self.bias_step = bias.detach()/self.steps
+            self.bias_step_key = key
+        return self.bias_step
+
+    def compressed_weight(self):
+        key = self.weight_key()
+        if self.weight_csr is None or self.weight_csr_key != key:
+            self.weight_csr = self.effective_weight().detach().to_sparse_csr()
+            self.weight_csr_key = key
+        return self.weight_csr
+
+    def sparse_weight_linear(self,x,bias=None):
+        # x W^T + bias computed as the CSR-dense product W x^T; equal to F.linear up to float summation order
+        x2d = x.reshape(-1,x.shape[-1])
+        output = torch.sparse.mm(self.compressed_weight(),x2d.t()).t()
+        output = output + bias if bias is not None else output.contiguous()
+        return output.reshape(x.shape[:-1]+(self.linear.out_features,))
+
+    def weight_linear(self,x,bias=None):
+        if self.sparse_weight and self.sparse_weight_faster:
+            return self.sparse_weight_linear(x,bias)
+        return F.linear(x,self.effective_weight(),bias)
+
+    @torch.no_grad()
+    def calibrate_sparse_weight(self,num_rows,repeats=10):
+        '''
+        Time the dense path (self.linear) against sparse_weight_linear on num_rows random rows and
+        keep the CSR weight only if it is faster, which with unstructured pruning takes a very sparse
+        weight. The decision holds until weight_key() changes, e.g. when the weight is pruned.
+        '''
+        weight = self.effective_weight()
+        x = torch.randn(num_rows,self.linear.in_features,device=weight.device,dtype=weight.dtype)
+        dense_time = measure_time(lambda: self.linear(x),weight.device,repeats)
+        sparse_time = measure_time(lambda: self.sparse_weight_linear(x),weight.device,repeats)
+        self.sparse_weight_faster = sparse_time < dense_time
+        self.sparse_weight_key = self.weight_key()
+        if not self.sparse_weight_faster:
+            self.weight_csr = None
+        return self.sparse_weight_faster
+
+    def row_sparse_linear(self,x,threshold):
+        '''
+        The dense path below as a GEMM with the (quantized) effective_weight() on the non-zero rows
+        of x only, scattered into a zero (or, for IF layers, bias) output; equal to it up to float
+        rounding, since the ST-BIF dense path adds and removes the bias. Returns None when more
+        than threshold of the rows are non-zero.
+        '''
+        x2d = x.reshape(-1,x.shape[-1])
+        index = x2d.ne(0).any(dim=-1).nonzero().squeeze(1)
+        if index.numel() > threshold*x2d.shape[0]:
+            return None
+        bias = self.linear.bias
+        if bias is not None and self.neuron_type == 'IF':
+            # the zero rows of the dense path hold the bias
+            output = bias.expand(x2d.shape[0],-1).clone()
+            rows = self.weight_linear(x2d.index_select(0,index),bias)
+        else:
+            # ST-BIF: the realized bias is not added again
+            output = x2d.new_zeros((x2d.shape[0],self.linear.out_features))
+            rows = self.weight_linear(x2d.index_select(0,index))
+        output.index_copy_(0,index,rows)
+        return output.reshape(x.shape[:-1]+(self.linear.out_features,))
+
+    def transposed_weight(self):
+        key = self.weight_key()
+        if self.weight_t is None or self.weight_t_key != key:
+            self.weight_t = self.effective_weight().detach().t().contiguous()
+            self.weight_t_key = key
+        return self.weight_t
+
+    def spike_accumulate_linear(self,x):
+        '''
+        Accumulate-only execution for inputs holding nothing but {-theta, 0, +theta}, i.e. the
+        spikes of an IFNeuron: every row adds the weight columns of its positive spikes, subtracts
+        those of its negative ones (embedding_bag over W^T with the spike signs as weights) and is
+        scaled by theta once. W is effective_weight(), quantized for a QuanLinear; its transpose is
+        cached until weight_key() changes. Equal to the dense path up to float summation order.
+        Returns None when x is not ternary.
+        '''
+        x2d = x.reshape(-1,x.shape[-1])
+        rows, cols = x2d.nonzero(as_tuple=True)
+        values = x2d[rows,cols]
+        if values.numel() == 0:
+            return None
+        theta = values.abs().max()
+        if not values.abs().eq(theta).all():
+            return None
+        # nonzero() is row-major, so every row's spikes form one contiguous bag
+        counts = torch.bincount(rows,minlength=x2d.shape[0])
+        offsets = counts.cumsum(0) - counts
+        output = F.embedding_bag(cols,self.transposed_weight(),offsets,mode='sum',per_sample_weights=values.sign())
+        output = output.mul_(theta)
+        if self.linear.bias is not None and self.neuron_type == 'IF':
+            output = output.add_(self.linear.bias)
+        return output.reshape(x.shape[:-1]+(self.linear.out_features,))
+
+    @torch.no_grad()
+    def calibrate_row_sparse(self,num_rows,densities=(0.01,0.02,0.05,0.1,0.2,0.3,0.4,0.5,0.6,0.8),repeats=10):
+        '''
+        Time the dense path (self.linear, including the weight quantization of a QuanLinear that
+        row_sparse_linear pays as well) against row_sparse_linear on num_rows random rows at every
+        density and set row_sparse_threshold to the highest density at which the sparse path is
+        still faster.
+        '''
+        weight = self.effective_weight()
+        x = torch.randn(num_rows,self.linear.in_features,device=weight.device,dtype=weight.dtype)
+        dense_time = measure_time(lambda: self.linear(x),weight.device,repeats)
+        self.row_sparse_threshold = 0.0
+        for density in densities:
+            x_sparse = x*(torch.rand(num_rows,1,device=x.device) < density)
+            if measure_time(lambda: self.row_sparse_linear(x_sparse,1.0),weight.device,repeats) >= dense_time:
+                break
+            self.row_sparse_threshold = density
+        return self.row_sparse_threshold
+
     def forward(self,input):
         # print("LLLinear.steps",self.steps)
         x = input
@@ -777,42 +1575,68 @@ class LLLinear(nn.Module):
         # elif x.ndim == 3:
         #     B,C,N = x.shape
         # N = self.linear.out_features
-        if x.dim() == 3:
-            B, N, _ = x.shape
-            D = self.linear.out_features
-            shape_new = (B, N, D)
-        elif x.dim() == 2:
-            B, _ = x.shape
-            D = self.linear.out_features
-            shape_new = (B, D)
-        if self.zero_output is None:
-            self.zero_output = torch.zeros(size=shape_new,device=x.device,dtype=x.dtype)
-
-        if (not torch.is_tensor(x) and (x == 0.0)) or ((x==0.0).all()):
+        if self.zero_output is None or self.zero_output.shape[:-1] != x.shape[:-1] or self.zero_output.dtype != x.dtype or self.zero_output.device != x.device:
+            self.zero_output = shared_zeros(x.shape[:-1]+(self.linear.out_features,),x.dtype,x.device)
+
+        # Without a host sync the all-zero shortcut below cannot be taken, so the dense path runs
+        # instead. It gives the same result only for ST-BIF layers with a bias, which cancels
+        # outside the realizing step ((0 W + b) - b == 0); the other layers keep the synchronous check.
+        # A shared_zeros input (e.g. the encoder's zero steps) is known to be zero without a check.
+        # the event-driven paths below bypass self.linear; forward hooks on it have to see every GEMM
+        event_driven = not has_forward_hooks(self.linear)
+        sync_free = self.activity is not None and self.neuron_type != 'IF' and self.linear.bias is not None and event_driven
+        if is_shared_zeros(x) or (not sync_free and ((not torch.is_tensor(x) and (x == 0.0)) or (not x.any()))):
             self.is_work = False
             if self.realize_time > 0:
-                output = self.zero_output + (self.linear.bias.data.unsqueeze(0)/self.steps if self.linear.bias is not None else 0.0)
+                output = self.step_bias().expand(self.zero_output.shape) if self.linear.bias is not None else self.zero_output
                 self.realize_time = self.realize_time - 1
                 self.is_work = True
+                if self.activity is not None:
+                    self.activity.fill_(True)
                 return output
             return self.zero_output
-
-        output = self.linear(x)
-
-        if self.neuron_type == 'IF':
+        if sync_free:
+            if self.realize_time > 0:
+                self.activity.fill_(True)
+            else:
+                mark_activity(self.activity, x)
+
+        if event_driven and self.sparse_weight and (self.sparse_weight_faster is None or self.sparse_weight_key != self.weight_key()):
+            self.calibrate_sparse_weight(x.numel()//x.shape[-1])
+
+        output = None
+        # the step that realizes the bias of an ST-BIF layer always runs dense
+        bias_realized = self.neuron_type == 'IF' or self.linear.bias is None or self.realize_time <= 0
+        if event_driven and self.spike_accumulate and bias_realized and not x.is_cuda:
+            output = self.spike_accumulate_linear(x)
+        if output is None and event_driven and self.row_sparse and bias_realized:
+            if self.row_sparse_threshold is None:
+                self.calibrate_row_sparse(x.numel()//x.shape[-1])
+            output = self.row_sparse_linear(x,self.row_sparse_threshold)
+
+        if output is not None:
             pass
-        else:
-            if self.linear.bias is None:
-                pass
+        elif self.neuron_type == 'IF' or self.linear.bias is None:
+            output = self.sparse_weight_linear(x,self.linear.bias) if event_driven and self.sparse_weight and self.sparse_weight_faster else self.linear(x)
+        elif event_driven and self.sparse_weight and self.sparse_weight_faster:
+            # CSR weight: bias/steps in the realizing steps, no bias afterwards
+            if self.realize_time > 0:
+                output = self.sparse_weight_linear(x,self.step_bias())
+                self.realize_time = self.realize_time - 1
             else:
-                output = output - (self.linear.bias.data.unsqueeze(0) if self.linear.bias is not None else 0.0)
-                if self.realize_time > 0:
-                    output = output + (self.linear.bias.data.unsqueeze(0)/self.steps if self.linear.bias is not None else 0.0)
-                    self.realize_time = self.realize_time - 1
-
+                output = self.sparse_weight_linear(x)
+        else:
+            output = self.linear(x)
+            # the realized bias is not added again; bias/steps in the realizing steps
+            output.sub_(self.linear.bias.detach())
+            if self.realize_time > 0:
+                output.add_(self.step_bias())
+                self.realize_time = self.realize_time - 1
 
         self.is_work = True
         self.first = False
+        if self.activity is not None and not sync_free:
+            self.activity.fill_(True)
 
         return output
 
@@ -831,17 +1655,30 @@ class Attention_no_softmax(nn.Module):
         self.attn_Relu = nn.ReLU(inplace=True)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        # > 0: evaluate the attention over blocks of attention_chunk query rows (exact)
+        self.attention_chunk = 0
+        # reassociate to Q (K^T V) / N, linear in N, where that is exact: the ReLU on the scores
+        # only vanishes when q and k hold no negative entry (checked per call, one host sync);
+        # otherwise the quadratic (or chunked) path runs
+        self.linear_attention = False
 
     def forward(self, x):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = self.attn_Relu(attn)/N
-        attn = self.attn_drop(attn)
+        if self.linear_attention and not (self.training and self.attn_drop.p > 0) and bool(q.min() >= 0) and bool(k.min() >= 0):
+            # q.k >= 0 for all pairs: relu(Q K^T) V == Q (K^T V)
+            x = (q * self.scale) @ (k.transpose(-2, -1) @ v) / N
+        elif self.attention_chunk > 0:
+            x = chunked_attention(q, k, v, lambda attn: self.attn_drop(self.attn_Relu(attn * self.scale)/N), self.attention_chunk)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = self.attn_Relu(attn)/N
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
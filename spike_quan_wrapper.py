@@ -5,20 +5,231 @@ import math
 import torch
 import torch.nn.functional as F
 from torch.autograd import Variable
-from spike_quan_layer import MyQuan,IFNeuron,LLConv2d,LLLinear,ORIIFNeuron,SpikeMaxPooling,QAttention,SAttention,spiking_softmax,Spiking_LayerNorm,QuanConv2d,QuanLinear,Attention_no_softmax, MyLayerNorm,MyBatchNorm1d,ORIIFNeuron
+from spike_quan_layer import shared_zeros,KLCalibrator,PercentileCalibrator,MSECalibrator,MyQuan,IFNeuron,LLConv2d,LLLinear,ORIIFNeuron,SpikeMaxPooling,QAttention,SAttention,spiking_softmax,Spiking_LayerNorm,FrozenQuanWeight,QuanConv2d,QuanLinear,Attention_no_softmax, MyLayerNorm,MyBatchNorm1d,ORIIFNeuron
 import sys
 from timm.models.vision_transformer import Attention,Mlp,Block
-from copy import deepcopy
-
-def get_subtensors(tensor,mean,std,sample_grain=255,output_num=4):
-    for i in range(int(sample_grain)):
-        output = (tensor/sample_grain).unsqueeze(0)
-        # output = (tensor).unsqueeze(0)
-        if i == 0:
-            accu = output
+from collections import OrderedDict
+from torch.utils.hooks import RemovableHandle
+
+class AnalogEncoder():
+    # the whole input at t = 0, zeros afterwards; the zeros are a shared_zeros view, which the
+    # first layer recognizes as zero without a check
+    def __init__(self,x,level):
+        self.x = x
+
+    def __call__(self,t):
+        if t == 0:
+            return self.x
+        return shared_zeros(self.x.shape,self.x.dtype,self.x.device)
+
+    def compact(self,index):
+        self.x = self.x.index_select(0,index)
+
+
+class RateEncoder(AnalogEncoder):
+    # x/level for the first level timesteps, zeros afterwards; the per-step input is
+    # produced on demand instead of materialising the [level, B, ...] stack
+    def __init__(self,x,level):
+        super(RateEncoder,self).__init__(x/level,level)
+        self.level = int(level)
+
+    def __call__(self,t):
+        if t < self.level:
+            return self.x
+        return super(RateEncoder,self).__call__(t)
+
+
+# Encoding_type -> encoder class, called as ENCODERS[name](x, level) and then encoder(t) for
+# every timestep t; unknown types fall back to analog encoding
+ENCODERS = {
+    "analog": AnalogEncoder,
+    "rate": RateEncoder,
+}
+
+def register_encoder(name,encoder):
+    ENCODERS[name] = encoder
+
+class StoppingPolicy():
+    # Anytime stopping: decides per sample from the running logits `accu` whether the prediction is
+    # settled. __call__(t, accu) gets the number of steps run so far and returns a bool tensor with
+    # one entry per row of accu. Counters of stopped samples and saved timesteps accumulate across
+    # batches until clear_stats().
+    def __init__(self,min_T=1):
+        self.min_T = min_T
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.num_samples = 0
+        self.num_stopped = 0
+        self.saved_T = 0
+
+    def reset(self):
+        # per-batch state
+        pass
+
+    def compact(self,index):
+        pass
+
+    def decide(self,t,accu):
+        raise NotImplementedError
+
+    def __call__(self,t,accu):
+        stop = self.decide(t,accu.float())
+        if t < self.min_T:
+            stop = torch.zeros_like(stop)
+        return stop
+
+    def record(self,sample_T,stopped,run_T):
+        # sample_T: step at which each sample stopped, stopped: the samples this policy stopped;
+        # the saving is counted against the steps the batch actually ran (run_T), a lower bound of
+        # the steps a sample would have needed without the policy
+        self.num_samples += sample_T.numel()
+        self.num_stopped += int(stopped.sum())
+        self.saved_T += int((run_T - sample_T[stopped]).sum())
+
+    def summary(self):
+        return {"stopped": self.num_stopped, "samples": self.num_samples, "saved_T": self.saved_T,
+                "mean_saved_T": self.saved_T / max(self.num_samples, 1)}
+
+
+class StableTop1Policy(StoppingPolicy):
+    # stop once the top-1 class has not changed for `patience` consecutive steps
+    def __init__(self,patience=10,min_T=1):
+        super(StableTop1Policy,self).__init__(min_T=min_T)
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self.pred = None
+        self.count = None
+
+    def compact(self,index):
+        self.pred = self.pred.index_select(0,index)
+        self.count = self.count.index_select(0,index)
+
+    def decide(self,t,accu):
+        pred = accu.argmax(-1)
+        if self.pred is None:
+            self.count = torch.zeros_like(pred)
         else:
-            accu = torch.cat((accu,output),dim=0)
-    return accu
+            self.count = torch.where(pred == self.pred,self.count + 1,0)
+        self.pred = pred
+        return self.count >= self.patience
+
+
+class MarginPolicy(StoppingPolicy):
+    # stop once the softmax margin between the top-1 and top-2 class reaches `threshold`
+    def __init__(self,threshold=0.5,min_T=1):
+        super(MarginPolicy,self).__init__(min_T=min_T)
+        self.threshold = threshold
+
+    def decide(self,t,accu):
+        top2 = accu.softmax(-1).topk(2,dim=-1).values
+        return (top2[:,0] - top2[:,1]) >= self.threshold
+
+
+class EntropyPolicy(StoppingPolicy):
+    # stop once the entropy (in nats) of the softmax falls to `threshold`
+    def __init__(self,threshold=0.5,min_T=1):
+        super(EntropyPolicy,self).__init__(min_T=min_T)
+        self.threshold = threshold
+
+    def decide(self,t,accu):
+        log_p = accu.log_softmax(-1)
+        entropy = -(log_p.exp()*log_p).sum(-1)
+        return entropy <= self.threshold
+
+
+STOPPING_POLICIES = {
+    "stable": lambda threshold, patience, min_T: StableTop1Policy(patience=patience, min_T=min_T),
+    "margin": lambda threshold, patience, min_T: MarginPolicy(threshold=threshold, min_T=min_T),
+    "entropy": lambda threshold, patience, min_T: EntropyPolicy(threshold=threshold, min_T=min_T),
+}
+
+def build_stopping_policy(name,threshold=0.5,patience=10,min_T=1):
+    if name is None or name == "none":
+        return None
+    return STOPPING_POLICIES[name](threshold, patience, min_T)
+
+
+STATEFUL_MODULES = (IFNeuron, ORIIFNeuron, LLLinear, LLConv2d, SAttention, Spiking_LayerNorm, spiking_softmax, SpikeMaxPooling)
+
+def set_compact_state(model):
+    # store the IFNeuron state compactly (exact), see IFNeuron.allocate_state
+    for module in model.modules():
+        if isinstance(module, IFNeuron):
+            module.compact_state = True
+
+def set_step_mode(model,step_mode='m'):
+    # IFNeuron/ORIIFNeuron step mode: 'm' takes a [T, B, ...] input and runs all T steps in one call,
+    # for layers driven over all timesteps at once; SNNWrapper steps the model with 's'
+    for module in model.modules():
+        if isinstance(module, (IFNeuron, ORIIFNeuron)):
+            module.step_mode = step_mode
+
+def set_persistent_state(model):
+    # keep the SNN state tensors across batches and zero them in place on reset
+    for module in model.modules():
+        if isinstance(module, (IFNeuron, LLConv2d, LLLinear, SAttention, Spiking_LayerNorm, spiking_softmax)):
+            module.persistent_state = True
+
+def set_row_sparse(model,threshold=None):
+    # event-driven LLLinear: GEMM on the token rows that carry spikes only, up to a row density of
+    # threshold (None: each layer calibrates its own crossover at its first sparse step)
+    for module in model.modules():
+        if isinstance(module, LLLinear):
+            module.row_sparse = True
+            module.row_sparse_threshold = threshold
+
+def set_spike_accumulate(model,layers=None):
+    # CPU accumulate-only LLLinear for ternary spike inputs; layers: name substrings selecting the
+    # layers (e.g. ["qkv", "fc2"]), None or empty selects every LLLinear
+    for name, module in model.named_modules():
+        if isinstance(module, LLLinear) and (not layers or any(layer in name for layer in layers)):
+            module.spike_accumulate = True
+
+def set_sparse_weight(model,layers=None):
+    # LLLinear with CSR weights, kept per layer only where it beats the dense GEMM; layers: name
+    # substrings selecting the layers, None or empty selects the ones unstruct_prune prunes
+    layers = layers or ["proj", "fc2"]
+    for name, module in model.named_modules():
+        if isinstance(module, LLLinear) and any(layer in name for layer in layers):
+            module.sparse_weight = True
+            module.sparse_weight_faster = None
+
+def set_head_skip(model):
+    # SAttention: skip the (batch, head) slices without new q/k/v spikes and silent attention neurons
+    for module in model.modules():
+        if isinstance(module, SAttention):
+            module.head_skip = True
+
+def set_row_skip_softmax(model):
+    # spiking_softmax: recompute only the rows whose input changed this step
+    for module in model.modules():
+        if isinstance(module, spiking_softmax):
+            module.skip_unchanged_rows = True
+
+def set_row_skip_layernorm(model):
+    # Spiking_LayerNorm: normalize only the tokens whose input changed this step
+    for module in model.modules():
+        if isinstance(module, Spiking_LayerNorm):
+            module.skip_unchanged_rows = True
+
+def set_frozen_weights(model,drop_weight=False):
+    # QuanConv2d/QuanLinear: quantize the weights once for evaluation; drop_weight also frees the
+    # float weights, after which the model can only be evaluated (and its state_dict lacks them)
+    for module in model.modules():
+        if isinstance(module, FrozenQuanWeight):
+            module.freeze(drop_weight=drop_weight)
+
+def set_attention_chunk(model,chunk=0,linear_attention=False):
+    # QANN/ANN attention: row-block evaluation of the N x N map (exact) and, softmax-free
+    # Attention_no_softmax only, the linear-in-N reassociation Q (K^T V) where it is exact
+    for module in model.modules():
+        if isinstance(module, (QAttention, Attention_no_softmax)):
+            module.attention_chunk = chunk
+        if isinstance(module, Attention_no_softmax):
+            module.linear_attention = linear_attention
 
 def reset_model(model):
     children = list(model.named_children())
@@ -35,21 +246,49 @@ def reset_model(model):
 class Judger():
 	def __init__(self):
 		self.network_finish=True
+		self.activity=None
+		self.activity_history=None
 
-	def judge_finish(self,model):
-		children = list(model.named_children())
-		for name, child in children:
-			is_need = False
-			if isinstance(child, IFNeuron) or isinstance(child, LLLinear) or isinstance(child, LLConv2d):
-				self.network_finish = self.network_finish and (not model._modules[name].is_work)
-				# print("child",child,"network_finish",self.network_finish,"model._modules[name].is_work",(model._modules[name].is_work))
-				is_need = True
-			if not is_need:
-				self.judge_finish(child)
+	def judge_finish_modules(self,modules):
+		# the network is finished once no module of SNNWrapper.finish_modules (IFNeuron, LLLinear,
+		# LLConv2d, Spiking_LayerNorm) worked in this step
+		for module in modules:
+			if module.is_work:
+				self.network_finish = False
+				return
 
 	def reset_network_finish_flag(self):
 		self.network_finish = True
 
+	def attach_activity(self,modules,device,interval,batch_size=None):
+		# one device-side flag shared by every IFNeuron/LLLinear/LLConv2d/Spiking_LayerNorm, copied into
+		# activity_history after each step and read back by the host once per interval;
+		# with batch_size the flag holds one entry per sample
+		shape = () if batch_size is None else (batch_size,)
+		if self.activity is None or self.activity.device != device or self.activity_history.shape != (interval,)+shape:
+			self.activity = torch.zeros(shape,dtype=torch.bool,device=device)
+			self.activity_history = torch.zeros((interval,)+shape,dtype=torch.bool,device=device)
+			for module in modules:
+				module.activity = self.activity
+		self.activity.zero_()
+
+	def record_activity(self,index):
+		self.activity_history[index].copy_(self.activity)
+		self.activity.zero_()
+
+	def first_idle_step(self,n):
+		# the only host sync: index of the first of the last n steps without any activity
+		history = self.activity_history[:n].tolist()
+		if all(history):
+			return None
+		return history.index(False)
+
+	def first_idle_steps(self,n):
+		# per-sample variant: for every sample the index of its first idle step among the last n, or -1
+		idle = ~self.activity_history[:n]
+		first = idle.to(torch.uint8).argmax(0)
+		return torch.where(idle.any(0),first,-1).tolist()
+
 def attn_convert(QAttn:QAttention,SAttn:SAttention,level,neuron_type):
     SAttn.qkv = LLLinear(linear = QAttn.qkv,neuron_type = "ST-BIF",level = level)
     SAttn.proj = LLLinear(linear = QAttn.proj,neuron_type = "ST-BIF",level = level)
@@ -143,14 +382,93 @@ class SNNWrapper(nn.Module):
         self.is_softmax = kwargs["is_softmax"]
         self.max_T = 0
         self.visualize = False
+        # > 0: judge the finish from a device-side activity flag read every finish_check_interval steps
+        self.finish_check_interval = kwargs.get("finish_check_interval", 0)
+        # freeze the logits of every sample as soon as it is quiescent and drop it from the batch
+        self.early_exit = kwargs.get("early_exit", False)
+        # StoppingPolicy that freezes the logits of a sample once its prediction is settled
+        self.stopping_policy = kwargs.get("stopping_policy", None)
+        # per-sample stop step of the last batch (early_exit or stopping_policy)
+        self.sample_T = None
+        self._step_hooks = OrderedDict()
         # self.model_reset = None
         if self.model_name.count("vit") > 0:
-            self.pos_embed = deepcopy(self.model.pos_embed.data)
-            self.cls_token = deepcopy(self.model.cls_token.data)
+            # the embeddings are added at t = 0 only; later steps swap in all-zero stand-ins. Both
+            # are plain dicts: the real parameters stay registered on self.model only
+            self.embeddings = {"pos_embed": self.model.pos_embed, "cls_token": self.model.cls_token}
+            self.zero_embeddings = {}
 
         self._replace_weight(self.model)
+        self._build_state_registry()
+        if kwargs.get("compact_state", False):
+            set_compact_state(self.model)
+        if kwargs.get("persistent_state", False):
+            set_persistent_state(self.model)
+        if kwargs.get("head_skip", False):
+            set_head_skip(self.model)
+        if kwargs.get("row_skip_softmax", False):
+            set_row_skip_softmax(self.model)
+        if kwargs.get("row_skip_layernorm", False):
+            set_row_skip_layernorm(self.model)
+        if kwargs.get("spike_accumulate", None) is not None:
+            set_spike_accumulate(self.model, layers=kwargs["spike_accumulate"])
+        if kwargs.get("sparse_weight", None) is not None:
+            set_sparse_weight(self.model, layers=kwargs["sparse_weight"])
+        if kwargs.get("row_sparse", False):
+            set_row_sparse(self.model, threshold=kwargs.get("row_sparse_threshold", None))
         # self.model_reset = deepcopy(self.model)        
     
+    def _build_state_registry(self):
+        # flat, ordered registry of the stateful modules, built once after _replace_weight
+        #   stateful_modules: (name, module) of every stateful module, nested ones included
+        #   reset_modules:    the outermost ones; e.g. SAttention.reset() already resets its own neurons
+        #   finish_modules:   the modules whose is_work the finish check looks at
+        self.stateful_modules = []
+        self.reset_modules = []
+        self.finish_modules = []
+        root = None
+        for name, module in self.model.named_modules():
+            if not isinstance(module, STATEFUL_MODULES):
+                continue
+            self.stateful_modules.append((name, module))
+            if root is None or not name.startswith(root + "."):
+                root = name
+                self.reset_modules.append(module)
+            if isinstance(module, IFNeuron) or isinstance(module, LLLinear) or isinstance(module, LLConv2d) or isinstance(module, Spiking_LayerNorm):
+                self.finish_modules.append(module)
+
+    def named_stateful_modules(self):
+        return iter(self.stateful_modules)
+
+    def register_state_hook(self,hook):
+        # register a forward hook on every stateful module, e.g. for spike/activity profiling
+        return [module.register_forward_hook(hook) for _, module in self.stateful_modules]
+
+    def head_activity_stats(self):
+        # (batch, head) attention slices seen and skipped by head_skip, summed over all SAttention
+        stats = {"head_steps": 0, "head_skipped": 0}
+        for _, module in self.stateful_modules:
+            if isinstance(module, SAttention) and module.head_skip:
+                stats["head_steps"] += module.head_steps
+                stats["head_skipped"] += module.head_skipped
+        stats["skip_rate"] = stats["head_skipped"] / max(stats["head_steps"], 1)
+        return stats
+
+    def state_nbytes(self):
+        # memory currently held by the IFNeuron state tensors
+        nbytes = 0
+        for _, module in self.stateful_modules:
+            if isinstance(module, IFNeuron) or isinstance(module, ORIIFNeuron):
+                for state in (module.q, module.acc_q, module.cur_output):
+                    if torch.is_tensor(state):
+                        nbytes += state.numel() * state.element_size()
+        return nbytes
+
+    def compact(self,index):
+        # keep only the batch rows in index of every stateful module
+        for _, module in self.stateful_modules:
+            module.compact(index)
+
     def hook_mid_feature(self):
         self.feature_list = []
         self.input_feature_list = []
@@ -166,13 +484,31 @@ class SNNWrapper(nn.Module):
         print("self.feature_list",self.feature_list.shape) 
         print("self.input_feature_list",self.input_feature_list.shape) 
             
+    def swap_embeddings(self,zero):
+        # point the ViT pos_embed/cls_token at cached all-zero parameters (zero=True) or back at the
+        # real ones; a pointer swap, nothing is copied
+        for name in ("pos_embed","cls_token"):
+            current = getattr(self.model,name)
+            if current is not self.zero_embeddings.get(name):
+                # the real parameter, as it is now (a load or a move may have replaced it)
+                self.embeddings[name] = current
+            param = self.embeddings[name]
+            if zero:
+                stand_in = self.zero_embeddings.get(name)
+                if stand_in is None or stand_in.shape != param.shape or stand_in.dtype != param.dtype or stand_in.device != param.device:
+                    stand_in = nn.Parameter(torch.zeros_like(param),requires_grad=False)
+                    self.zero_embeddings[name] = stand_in
+                param = stand_in
+            setattr(self.model,name,param)
+
     def reset(self):
         # self.model = deepcopy(self.model_reset).cuda()
-        self.model.pos_embed.data = deepcopy(self.pos_embed).cuda()
-        self.model.cls_token.data = deepcopy(self.cls_token).cuda()
+        if self.model_name.count("vit") > 0:
+            self.swap_embeddings(zero=False)
         # print(self.model.pos_embed)
         # print(self.model.cls_token)
-        reset_model(self)
+        for module in self.reset_modules:
+            module.reset()
     
     def _replace_weight(self,model):
         children = list(model.named_children())
@@ -212,42 +548,75 @@ class SNNWrapper(nn.Module):
             if not is_need:            
                 self._replace_weight(child)
 
-    def forward(self,x, verbose=False):
+    def register_step_hook(self,hook):
+        # hook(t, accu_t) is called after every timestep with the number of steps run so far and the
+        # logits the forward would return if it stopped there
+        handle = RemovableHandle(self._step_hooks)
+        self._step_hooks[handle.id] = hook
+        return handle
+
+    def stream(self,x):
+        # generator over the timesteps: yields (t, accu_t) after every step and returns (accu, T) at
+        # the end. With finish_check_interval > 0 the finish is only seen at the window checks, so up
+        # to finish_check_interval-1 steps past T may be yielded; their logits equal the final ones.
         accu = None
         count1 = 0
-        accu_per_timestep = []
         # print("self.bit",self.bit)
         # x = x*(2**self.bit-1)+0.0
-        if self.visualize:
-            self.hook_mid_feature()
-        if self.Encoding_type == "rate":
-            self.mean = 0.0
-            self.std  = 0.0
-            x = get_subtensors(x,self.mean,self.std,sample_grain=self.level)
-            # print("x.shape",x.shape)
+        encoder = ENCODERS.get(self.Encoding_type, AnalogEncoder)(x,self.level)
+        network_finish = False
+        policy = self.stopping_policy
+        per_sample = self.early_exit or policy is not None
+        check_interval = max(self.finish_check_interval, 1) if self.early_exit else self.finish_check_interval
+        if per_sample:
+            # active: original batch index of every row still being simulated
+            batch_size = x.shape[0]
+            active = torch.arange(batch_size,device=x.device)
+            result = None
+            self.sample_T = torch.zeros(batch_size,dtype=torch.long)
+            policy_stopped = torch.zeros(batch_size,dtype=torch.bool)
+        if policy is not None:
+            # policy_T: step at which the policy stopped each active row (-1: not yet), frozen: its logits then
+            policy.reset()
+            policy_T = torch.full((batch_size,),-1,dtype=torch.long,device=x.device)
+            frozen = None
+        if check_interval > 0:
+            self.finish_judger.attach_activity(self.finish_modules,x.device,check_interval,
+                                               batch_size=batch_size if self.early_exit else None)
+            accu_window = []
+
+        def active_output():
+            # logits of the active rows as returned if the run stopped now
+            if policy is None:
+                return accu
+            return torch.where(policy_T.ge(0).unsqueeze(-1),frozen,accu)
+
+        def finish_rows(rows,rows_T):
+            nonlocal result
+            index = torch.tensor(rows,device=x.device)
+            if result is None:
+                result = accu.new_zeros((batch_size,)+accu.shape[1:])
+            result.index_copy_(0,active[index],active_output()[index])
+            self.sample_T[active[index].cpu()] = torch.tensor(rows_T)
+            if policy is not None:
+                policy_stopped[active[index].cpu()] = policy_T[index].ge(0).cpu()
+
         while(1):
-            self.finish_judger.reset_network_finish_flag()
-            self.finish_judger.judge_finish(self)
-            network_finish = self.finish_judger.network_finish
+            if check_interval == 0:
+                self.finish_judger.reset_network_finish_flag()
+                self.finish_judger.judge_finish_modules(self.finish_modules)
+                network_finish = self.finish_judger.network_finish
+                if policy is not None and count1 > 0 and bool(policy_T.ge(0).all()):
+                    # the policy froze the logits of every sample: later steps cannot change the output
+                    network_finish = True
             # print(f"==================={count1}===================")
             if (count1 > 0 and network_finish) or count1 >= self.T:
                 self.max_T = max(count1, self.max_T)
                 break
             # if self.neuron_type.count("QFFS") != -1 or self.neuron_type == 'ST-BIF':
-            if self.model_name.count("vit")>0 and count1 > 0:
-                self.model.pos_embed = nn.Parameter(torch.zeros(1, self.model.patch_embed.num_patches + 1, self.model.
-                                                                embed_dim).to(x.device))
-                self.model.cls_token = nn.Parameter(torch.zeros(1, 1, self.model.embed_dim).to(x.device))
-            if self.Encoding_type == "rate":
-                if count1 < x.shape[0]:
-                    input = x[count1]
-                else:
-                    input = torch.zeros(x[0].shape).to(x.device)            
-            else:
-                if count1 == 0:
-                    input = x
-                else:
-                    input = torch.zeros(x.shape).to(x.device)
+            if self.model_name.count("vit")>0 and count1 == 1:
+                self.swap_embeddings(zero=True)
+            input = encoder(count1)
             # elif self.neuron_type == 'IF':
             #     input = x
             # else:
@@ -262,12 +631,95 @@ class SNNWrapper(nn.Module):
                 accu = output+0.0
             else:
                 accu = accu+output
-            if verbose:
-                accu_per_timestep.append(accu)
+            if policy is not None:
+                fired = policy(count1 + 1,accu).logical_and_(policy_T.lt(0))
+                policy_T = torch.where(fired,count1 + 1,policy_T)
+                frozen = accu if frozen is None else torch.where(fired.unsqueeze(-1),accu,frozen)
+            if check_interval > 0:
+                self.finish_judger.record_activity(len(accu_window))
+                accu_window.append(accu)
             # print("accu",accu.sum(),"output",output.sum())
             count1 = count1 + 1
             if count1 % 100 == 0:
                 print(count1)
+            step_output = accu
+            if per_sample:
+                step_output = active_output()
+                if result is not None:
+                    step_output = result.index_copy(0,active,step_output)
+            for hook in self._step_hooks.values():
+                hook(count1,step_output)
+            yield count1,step_output
+            if check_interval > 0 and (len(accu_window) == check_interval or count1 >= self.T):
+                start = count1 - len(accu_window)
+                if self.early_exit:
+                    # a row is done at its first idle step (a quiescent sample only adds zeros from
+                    # then on) or at the step its policy fired, whichever comes first
+                    idle = self.finish_judger.first_idle_steps(len(accu_window))
+                    stopped = policy_T.tolist() if policy is not None else [-1]*len(idle)
+                    done_T = [p if p >= 0 else (start + i + 1 if i >= 0 else -1) for i, p in zip(idle, stopped)]
+                    done = [b for b, t in enumerate(done_T) if t >= 0]
+                    stop = []
+                    if len(done) > 0:
+                        finish_rows(done,[done_T[b] for b in done])
+                        keep = [b for b, t in enumerate(done_T) if t < 0]
+                        if len(keep) > 0:
+                            keep = torch.tensor(keep,device=x.device)
+                            self.compact(keep)
+                            encoder.compact(keep)
+                            accu = accu.index_select(0,keep)
+                            active = active[keep]
+                            if policy is not None:
+                                policy.compact(keep)
+                                policy_T = policy_T.index_select(0,keep)
+                                frozen = frozen.index_select(0,keep)
+                            self.finish_judger.attach_activity(self.finish_modules,x.device,check_interval,batch_size=len(keep))
+                        else:
+                            active = active[:0]
+                            stop = [max(done_T) - start - 1]
+                else:
+                    idle = self.finish_judger.first_idle_step(len(accu_window))
+                    stop = [idle] if idle is not None else []
+                    if policy is not None and bool(policy_T.ge(0).all()):
+                        # the logits of every sample are frozen from the last policy stop on
+                        stop = [min(stop + [int(policy_T.max()) - start - 1])]
+                if len(stop) > 0:
+                    # the per-step check would have stopped right after the last idle step; the
+                    # steps run since then only added zeros, so roll back to it
+                    extra = len(accu_window) - max(stop) - 1
+                    count1 = count1 - extra
+                    if not self.early_exit:
+                        accu = accu_window[max(stop)]
+                        if policy is not None:
+                            # stops the policy made in the rolled back steps never happened
+                            policy_T = torch.where(policy_T.gt(count1),-1,policy_T)
+                    network_finish = True
+                accu_window = []
+
+        if self.model_name.count("vit")>0:
+            self.swap_embeddings(zero=False)
+        if per_sample:
+            if active.numel() > 0:
+                rows_T = count1 if policy is None else torch.where(policy_T.ge(0),policy_T,count1).tolist()
+                finish_rows(list(range(active.numel())),rows_T)
+            accu = result
+            if policy is not None:
+                policy.record(self.sample_T,policy_stopped,count1)
+        return accu,count1
+
+    def forward(self,x, verbose=False):
+        accu_per_timestep = []
+        if self.visualize:
+            self.hook_mid_feature()
+        stream = self.stream(x)
+        while(1):
+            try:
+                t, accu_t = next(stream)
+            except StopIteration as finish:
+                accu, count1 = finish.value
+                break
+            if verbose:
+                accu_per_timestep.append(accu_t)
 
         # print("verbose",verbose)
         print("\nTime Step:",count1)
@@ -276,7 +728,7 @@ class SNNWrapper(nn.Module):
             torch.save(self.feature_list,"model_blocks11_norm2.pth")
             torch.save(self.input_feature_list,"model_blocks11_norm2_input.pth")
         if verbose:
-            accu_per_timestep = torch.stack(accu_per_timestep,dim=0)
+            accu_per_timestep = torch.stack(accu_per_timestep[:count1],dim=0)
             return accu,count1,accu_per_timestep
         else:
             return accu,count1
@@ -390,5 +842,54 @@ def myquan_replace(model,level,weight_bit=32, is_softmax = True):
     if weight_bit < 32:
         _weight_quantization(model,weight_bit)
 
-
-
+CALIBRATORS = {
+    "kl": lambda quantizer, quantization_level, n_trial, percentile: KLCalibrator(quantization_level, n_trial),
+    "percentile": lambda quantizer, quantization_level, n_trial, percentile: PercentileCalibrator(
+        quantization_level, n_trial, percentile=percentile, unsigned=not quantizer.sym),
+    "mse": lambda quantizer, quantization_level, n_trial, percentile: MSECalibrator(
+        quantization_level, n_trial, neg_min=int(quantizer.neg_min), pos_max=int(quantizer.pos_max)),
+}
+
+def build_calibrator(method,quantizer,n_trial=300,percentile=99.99):
+    # a symmetric MyQuan spreads its levels over [-threshold, threshold], an unsigned one over
+    # [0, threshold], i.e. level levels on either side of the symmetric histogram
+    quantization_level = quantizer.level if quantizer.sym else 2*quantizer.level
+    return CALIBRATORS[method](quantizer, quantization_level, n_trial, percentile)
+
+@torch.no_grad()
+def calibrate_quantizers(model,data_loader,device,num_batches=32,method="kl",n_trial=300,percentile=99.99):
+    '''
+    Post-training calibration: set the step size s of every MyQuan of a QANN from the clipping
+    threshold its calibrator (method: "kl", "percentile" or "mse") picks on its input, collected
+    in a single sweep over num_batches batches of data_loader. The quantizers pass their input
+    through during the sweep, so every one sees float activations. In distributed runs the steps
+    of rank 0 are broadcast, so that every rank holds the same quantizers.
+    '''
+    calibrators = {}
+    handles = []
+    for module in model.modules():
+        if isinstance(module, MyQuan) and module.pos_max != 'full':
+            calibrators[module] = build_calibrator(method, module, n_trial=n_trial, percentile=percentile)
+            def hook(module, input, output):
+                calibrators[module].update(input[0])
+                return input[0]
+            handles.append(module.register_forward_hook(hook))
+
+    was_training = model.training
+    model.eval()
+    for batch_index, (samples, _) in enumerate(data_loader):
+        if batch_index >= num_batches:
+            break
+        model(samples.to(device, non_blocking=True))
+    for handle in handles:
+        handle.remove()
+    model.train(was_training)
+
+    for module, calibrator in calibrators.items():
+        threshold = calibrator.compute()
+        module.s.data = torch.tensor(2*threshold/calibrator.n_lvl, dtype=torch.float32, device=module.s.device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.broadcast(module.s.data, src=0)
+        # keep the calibrated step when training starts
+        module.init_state = 1
+    print(f"{method} calibration of {len(calibrators)} quantizers finished!")